@@ -34,8 +34,8 @@ import asyncio
 import aiohttp
 import uuid
 import logging
+import logging.handlers
 import os
-import traceback
 from threading import Thread
 from queue import Queue
 
@@ -46,7 +46,7 @@ SCRIPT_LICENSE = "MIT"
 SCRIPT_DESC    = "Matrix support en WeeChat via HTTP"
 
 # 1) Registro del plugin
-if not weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "", ""):
+if not weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "shutdown_cb", ""):
     raise Exception("Error al registrar el script en WeeChat")
 
 # 2) Configuración por defecto
@@ -54,23 +54,77 @@ _defaults = {
     "homeserver": ("https://matrix.org", "Matrix homeserver URL"),
     "username":   ("",               "Matrix username (e.g., @user:matrix.org)"),
     "password":   ("",               "Matrix password"),
-    "reconnect_interval": ("30",     "Segundos entre reintentos de conexión")
+    "reconnect_interval": ("30",     "Segundos entre reintentos de conexión"),
+    "log_level":  ("info",           "Nivel del log: debug, info, warning o error"),
+    "log_max_kb": ("1024",           "Rotar matrix.log al alcanzar este tamaño (0 no rota)"),
+    "log_backups": ("3",             "Logs rotados que se conservan"),
+    "log_redact": ("on",             "Ocultar mensajes, contraseña y token en el log (on/off)")
 }
 for opt, (val, desc) in _defaults.items():
     if not weechat.config_is_set_plugin(opt):
         weechat.config_set_plugin(opt, val)
         weechat.config_set_desc_plugin(opt, desc)
 
-# 3) Logging a ~/.weechat/matrix/matrix.log
+# 3) Logging a ~/.weechat/matrix/matrix.log, escrito desde un hilo aparte
+class Redacted:
+    """Argumento de log con cuerpos de mensaje o secretos; se muestra su longitud."""
+
+    enabled = True  # opción log_redact
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if Redacted.enabled:
+            return f"<redacted {len(str(self.value))} chars>"
+        return str(self.value)
+
+    __repr__ = __str__
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Encola los registros sin formatear; el listener los formatea y escribe."""
+
+    def prepare(self, record):
+        return record
+
 _weechat_dir = weechat.info_get("weechat_dir", "") or os.path.expanduser("~/.weechat")
 _log_dir = os.path.join(_weechat_dir, "matrix")
 os.makedirs(_log_dir, exist_ok=True)
-logging.basicConfig(
-    filename=os.path.join(_log_dir, "matrix.log"),
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s"
-)
+_log_file = logging.handlers.RotatingFileHandler(
+    os.path.join(_log_dir, "matrix.log"), maxBytes=1024 * 1024, backupCount=3, encoding="utf-8", delay=True)
+_log_file.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+_log_queue = Queue()
+log_listener = logging.handlers.QueueListener(_log_queue, _log_file)
+log_listener.start()
+LIBRARY_LOGGERS = ("aiohttp", "asyncio")  # también van a matrix.log, con log_level
+_queue_handler = LogQueueHandler(_log_queue)
+for _name in ("matrix",) + LIBRARY_LOGGERS:
+    logging.getLogger(_name).handlers[:] = [_queue_handler]
+    logging.getLogger(_name).propagate = False
 logger = logging.getLogger("matrix")
+
+def configure_logging():
+    """Aplica log_level, log_max_kb, log_backups y log_redact."""
+    level = logging.getLevelName(weechat.config_get_plugin("log_level").upper())
+    for name in ("matrix",) + LIBRARY_LOGGERS:
+        logging.getLogger(name).setLevel(level if isinstance(level, int) else logging.INFO)
+    try:
+        _log_file.maxBytes = max(0, int(weechat.config_get_plugin("log_max_kb"))) * 1024
+    except ValueError:
+        _log_file.maxBytes = 1024 * 1024
+    try:
+        _log_file.backupCount = max(0, int(weechat.config_get_plugin("log_backups")))
+    except ValueError:
+        _log_file.backupCount = 3
+    Redacted.enabled = bool(weechat.config_string_to_boolean(weechat.config_get_plugin("log_redact")))
+
+def log_config_cb(data, option, value):
+    configure_logging()
+    return weechat.WEECHAT_RC_OK
+
+configure_logging()
+weechat.hook_config("plugins.var.python.matrix.log_*", "log_config_cb", "")
 logger.debug("Script iniciado")  # Log inicial para confirmar que el script se cargó
 
 # 4) Cliente Matrix vía HTTP
@@ -97,8 +151,7 @@ class MatrixHTTP:
             logger.debug("Bucle de eventos iniciado")
             self.loop.run_forever()
         except Exception as e:
-            logger.error(f"Error en el bucle de eventos: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error en el bucle de eventos: %s", e)
 
     async def _login(self):
         try:
@@ -106,7 +159,7 @@ class MatrixHTTP:
             self.hs    = weechat.config_get_plugin("homeserver").rstrip("/")
             self.user  = weechat.config_get_plugin("username")
             self.passw = weechat.config_get_plugin("password")
-            logger.debug(f"Configuración: homeserver={self.hs}, username={self.user}")
+            logger.debug("Configuración: homeserver=%s, username=%s", self.hs, self.user)
             if not all([self.hs, self.user, self.passw]):
                 weechat.prnt("", "[matrix] Faltan homeserver/usuario/clave")
                 logger.warning("Faltan homeserver/usuario/clave")
@@ -114,24 +167,23 @@ class MatrixHTTP:
             self.session = aiohttp.ClientSession()
             url = f"{self.hs}/_matrix/client/v3/login"
             payload = {"type":"m.login.password","user":self.user,"password":self.passw}
-            logger.debug(f"Enviando solicitud de login a {url}")
+            logger.debug("Enviando solicitud de login a %s", url)
             async with self.session.post(url, json=payload) as resp:
                 res = await resp.json()
-            logger.debug(f"Respuesta del login: {res}")
+            logger.debug("Respuesta del login: %s", Redacted(res))
             if "access_token" not in res:
                 weechat.prnt("", f"[matrix] Login fallido: {res}")
-                logger.error(f"Login fallido: {res}")
+                logger.error("Login fallido: %s", res)
                 return
             self.token   = res["access_token"]
             self.user_id = res.get("user_id")
             weechat.prnt("", f"[matrix] Conectado como {self.user_id}")
-            logger.info(f"Conectado como {self.user_id}")
+            logger.info("Conectado como %s", self.user_id)
             # Arranca el bucle de sync inmediatamente
             asyncio.run_coroutine_threadsafe(self._sync_loop(), self.loop)
         except Exception as e:
             weechat.prnt("", f"[matrix] Error en login: {str(e)}")
-            logger.error(f"Error en login: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error en login: %s", e)
 
     async def _sync_loop(self):
         try:
@@ -142,7 +194,7 @@ class MatrixHTTP:
                 params = {"timeout": 30000}
                 if self.since:
                     params["since"] = self.since
-                logger.debug(f"Sincronizando con {url}, params={params}")
+                logger.debug("Sincronizando con %s, params=%s", url, params)
                 async with self.session.get(url, headers=headers, params=params) as resp:
                     data = await resp.json()
                 self.since = data.get("next_batch", self.since)
@@ -153,10 +205,9 @@ class MatrixHTTP:
                             sender = ev["sender"]
                             body   = ev["content"].get("body", "")
                             self.queue.put((rid, sender, body))
-                            logger.debug(f"Mensaje recibido en {rid} de {sender}: {body}")
+                            logger.debug("Mensaje recibido en %s de %s: %s", rid, sender, Redacted(body))
         except Exception as e:
-            logger.error(f"Error en sync_loop: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error en sync_loop: %s", e)
 
     def disconnect(self):
         try:
@@ -167,24 +218,22 @@ class MatrixHTTP:
             weechat.prnt("", "[matrix] Desconectado")
             logger.info("Desconectado")
         except Exception as e:
-            logger.error(f"Error al desconectar: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error al desconectar: %s", e)
 
     def join(self, room_id):
         try:
-            logger.debug(f"Intentando unirse a la sala {room_id}")
+            logger.debug("Intentando unirse a la sala %s", room_id)
             headers = {"Authorization": f"Bearer {self.token}"}
             url = f"{self.hs}/_matrix/client/v3/rooms/{room_id}/join"
             asyncio.run_coroutine_threadsafe(self.session.post(url, headers=headers), self.loop)
             weechat.prnt("", f"[matrix] Te uniste a {room_id}")
-            logger.info(f"Te uniste a {room_id}")
+            logger.info("Te uniste a %s", room_id)
         except Exception as e:
-            logger.error(f"Error al unirse a la sala {room_id}: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error al unirse a la sala %s: %s", room_id, e)
 
     def send(self, room_id, msg):
         try:
-            logger.debug(f"Enviando mensaje a {room_id}: {msg}")
+            logger.debug("Enviando mensaje a %s: %s", room_id, Redacted(msg))
             txn     = uuid.uuid4().hex
             headers = {"Authorization": f"Bearer {self.token}"}
             url     = f"{self.hs}/_matrix/client/v3/rooms/{room_id}/send/m.room.message/{txn}"
@@ -192,10 +241,9 @@ class MatrixHTTP:
             asyncio.run_coroutine_threadsafe(self.session.put(url, headers=headers, json=content), self.loop)
             buf = self._get_buffer(room_id)
             weechat.prnt(buf, f"{self.user_id}: {msg}")
-            logger.info(f"Mensaje enviado a {room_id}: {msg}")
+            logger.info("Mensaje enviado a %s: %s", room_id, Redacted(msg))
         except Exception as e:
-            logger.error(f"Error al enviar mensaje a {room_id}: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error al enviar mensaje a %s: %s", room_id, e)
 
     def list_rooms(self):
         try:
@@ -203,10 +251,9 @@ class MatrixHTTP:
             weechat.prnt("", "[matrix] Salas unidas:")
             for rid in self.buffers:
                 weechat.prnt("", f"- {rid}")
-                logger.info(f"Sala listada: {rid}")
+                logger.info("Sala listada: %s", rid)
         except Exception as e:
-            logger.error(f"Error al listar salas: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error al listar salas: %s", e)
 
     def _get_buffer(self, room_id):
         try:
@@ -214,11 +261,10 @@ class MatrixHTTP:
                 buf = weechat.buffer_new(f"matrix.{room_id}", "input_cb", "", "close_cb", "")
                 weechat.buffer_set(buf, "title", f"Matrix: {room_id}")
                 self.buffers[room_id] = buf
-                logger.debug(f"Buffer creado para {room_id}")
+                logger.debug("Buffer creado para %s", room_id)
             return self.buffers[room_id]
         except Exception as e:
-            logger.error(f"Error al crear buffer para {room_id}: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error al crear buffer para %s: %s", room_id, e)
 
     def process_queue(self, data, remaining):
         try:
@@ -226,11 +272,10 @@ class MatrixHTTP:
                 rid, sender, body = self.queue.get()
                 buf = self._get_buffer(rid)
                 weechat.prnt(buf, f"{sender}: {body}")
-                logger.debug(f"Procesando mensaje de la cola: {sender} en {rid}: {body}")
+                logger.debug("Procesando mensaje de la cola: %s en %s: %s", sender, rid, Redacted(body))
             return weechat.WEECHAT_RC_OK
         except Exception as e:
-            logger.error(f"Error al procesar cola: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error al procesar cola: %s", e)
             return weechat.WEECHAT_RC_OK
 
 # Instanciar cliente
@@ -246,8 +291,8 @@ weechat.hook_timer(500, 0, 0, "process_queue_callback", "")
 # 5) Comando /matrix
 def cmd_matrix(data, buffer, args):
     try:
-        logger.debug(f"Comando recibido: {args}")
         argv = args.split()
+        logger.debug("Comando recibido: %s", argv[:2] + [Redacted(a) for a in argv[2:]])
         if not argv:
             weechat.prnt("", "[matrix] Uso: connect|disconnect|join|send|list")
             logger.warning("Comando vacío")
@@ -268,12 +313,11 @@ def cmd_matrix(data, buffer, args):
             M.list_rooms()
         else:
             weechat.prnt("", "[matrix] Comando desconocido")
-            logger.warning(f"Comando desconocido: {cmd}")
+            logger.warning("Comando desconocido: %s", cmd)
         return weechat.WEECHAT_RC_OK
     except Exception as e:
         weechat.prnt("", f"[matrix] Error en comando: {str(e)}")
-        logger.error(f"Error en comando {args}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error en comando %s: %s", Redacted(args), e)
         return weechat.WEECHAT_RC_OK
 
 weechat.hook_command(
@@ -285,3 +329,9 @@ weechat.hook_command(
     "cmd_matrix",
     ""
 )
+
+# 6) Descarga del script: vaciar la cola del log antes de salir
+def shutdown_cb():
+    logger.info("Script descargado")
+    log_listener.stop()
+    return weechat.WEECHAT_RC_OK
@@ -1,13 +1,23 @@
 import weechat
-from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
-from telethon.events import NewMessage
+from telethon import TelegramClient, utils
+from telethon.errors import SessionPasswordNeededError, FloodWaitError
+from telethon.events import NewMessage, MessageEdited, MessageDeleted, ChatAction
+from telethon.sessions import SQLiteSession
+from telethon.tl import functions, types
+from telethon.tl.types import User, Channel
 import logging
+import logging.handlers
 import os
 import json
+import random
+import re
 import asyncio
+import bisect
 import time
-from queue import Queue
+import threading
+from datetime import datetime, timezone
+from collections import OrderedDict, deque
+from queue import Queue, Empty
 
 SCRIPT_NAME    = "telegram"
 SCRIPT_AUTHOR  = "santanaoliva_u"
@@ -17,56 +27,990 @@ SCRIPT_DESC    = "Telegram account support for WeeChat"
 
 # Globals
 logger      = None
+log_listener = None  # QueueListener writing log records on its own thread
+LIBRARY_LOGGERS = ("telethon", "asyncio")  # also written to telegram.log, at log_level
 CONFIG_DIR  = None
 SESSION_DIR = None
+CACHE_DIR   = None
 loop        = None
+loop_thread = None
 manager     = None
-tasks       = []  # Track async tasks
+tasks       = None  # TaskManager of in-flight coroutines
+main_calls  = Queue()  # (func, args) to run on the WeeChat main thread
+options     = {}  # plugins.var.python.telegram.* values, kept current by option_config_cb
+wakeup_r    = None  # pipe read end, hooked with hook_fd
+wakeup_w    = None  # pipe write end, written from the loop thread
+wakeup_hook = None
 
 
 def update_weechat_dir():
-    global CONFIG_DIR, SESSION_DIR
+    global CONFIG_DIR, SESSION_DIR, CACHE_DIR
     weechat_dir = weechat.info_get("weechat_dir", "") or os.path.expanduser("~/.weechat")
     CONFIG_DIR  = os.path.join(weechat_dir, "telegram")
     SESSION_DIR = os.path.join(CONFIG_DIR, "sessions")
+    CACHE_DIR   = os.path.join(CONFIG_DIR, "cache")
     os.makedirs(SESSION_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
     if not os.access(SESSION_DIR, os.W_OK):
         weechat.prnt("", f"Telegram: No write permissions for session directory: {SESSION_DIR}")
-        logger.error(f"No write permissions for session directory: {SESSION_DIR}")
+        logger.error("No write permissions for session directory: %s", SESSION_DIR)
     logger.debug("Updated session directory: %s", SESSION_DIR)
 
+# --- Logging ----------------------------------------------------------------
+
+class Redacted:
+    """Log argument for message bodies, codes and secrets; shown as its length."""
+
+    enabled = True  # log_redact option
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if Redacted.enabled:
+            return f"<redacted {len(str(self.value))} chars>"
+        return str(self.value)
+
+    __repr__ = __str__
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Pass records through unformatted; the listener thread formats and writes them."""
+
+    def prepare(self, record):
+        return record
+
 def setup_logging():
-    global logger, CONFIG_DIR, SESSION_DIR
+    global logger, log_listener, CONFIG_DIR, SESSION_DIR
     weechat_dir = os.path.expanduser("~/.weechat")
     CONFIG_DIR  = os.path.join(weechat_dir, "telegram")
     SESSION_DIR = os.path.join(CONFIG_DIR, "sessions")
     os.makedirs(SESSION_DIR, exist_ok=True)
     log_file = os.path.join(CONFIG_DIR, "telegram.log")
-    logging.basicConfig(filename=log_file, level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=1024 * 1024, backupCount=3, encoding="utf-8", delay=True)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    log_queue = Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    log_listener.start()
+    queue_handler = LogQueueHandler(log_queue)
+    for name in (SCRIPT_NAME,) + LIBRARY_LOGGERS:
+        named = logging.getLogger(name)
+        named.handlers[:] = [queue_handler]
+        named.propagate = False
+        named.setLevel(logging.INFO)  # Until configure_logging reads log_level
     logger = logging.getLogger(SCRIPT_NAME)
     logger.debug("Session directory: %s", SESSION_DIR)
 
+def configure_logging():
+    """Apply log_level, log_max_kb, log_backups and log_redact."""
+    level = logging.getLevelName(get_option("log_level").upper())
+    for name in (SCRIPT_NAME,) + LIBRARY_LOGGERS:
+        logging.getLogger(name).setLevel(level if isinstance(level, int) else logging.INFO)
+    file_handler = log_listener.handlers[0]
+    try:
+        file_handler.maxBytes = max(0, int(get_option("log_max_kb"))) * 1024
+    except ValueError:
+        file_handler.maxBytes = 1024 * 1024
+    try:
+        file_handler.backupCount = max(0, int(get_option("log_backups")))
+    except ValueError:
+        file_handler.backupCount = 3
+    Redacted.enabled = bool(weechat.config_string_to_boolean(get_option("log_redact")))
+
 def setup_config():
     defaults = {
         "api_id": ("", "Telegram API ID from my.telegram.org"),
         "api_hash": ("", "Telegram API Hash from my.telegram.org"),
-        "reconnect_interval": ("30", "Seconds between message checks")
+        "reconnect_interval": ("30", "Seconds between connection health checks"),
+        "reconnect_max_backoff": ("300", "Max seconds between reconnect attempts"),
+        "session_flush_interval": ("5", "Seconds between commits of the session file (0 commits on every save)"),
+        "autoconnect": ("off", "Connect all saved accounts when the script loads (on/off)"),
+        "autoconnect_parallel": ("4", "Max accounts connecting at the same time during autoconnect"),
+        "drain_budget_ms": ("20", "Max milliseconds spent printing queued messages per wakeup"),
+        "max_send_tasks": ("4", "Max chats sending in parallel per account"),
+        "send_coalesce_ms": ("0", "Join lines typed within this many ms into one message (0 disables)"),
+        "max_dialog_tasks": ("1", "Max concurrent dialog listing tasks"),
+        "max_auth_tasks": ("1", "Max concurrent add/code/password tasks"),
+        "entity_cache_size": ("10000", "Chats and senders kept per account in the entity cache, least recently seen dropped first"),
+        "dialog_refresh_interval": ("3600", "Seconds before the cached dialog list is refreshed in the background"),
+        "history_prefetch": ("20", "Messages of history shown and fetched when a chat buffer opens (0 disables)"),
+        "history_keep": ("1000", "Messages kept per chat in the local history store"),
+        "max_downloads": ("3", "Max concurrent media downloads"),
+        "media_auto_download_kb": ("512", "Download media up to this size automatically (0 disables)"),
+        "media_part_size_kb": ("512", "Part size for chunked media downloads (max 512)"),
+        "media_cache_mb": ("500", "Disk cap for downloaded media, least recently used files are evicted"),
+        "coalesce_ms": ("300", "Window for merging album parts and forwarded bursts into one block (0 disables)"),
+        "upload_part_size_kb": ("512", "Part size for file uploads, rounded down to a power of two (max 512)"),
+        "upload_parallel_parts": ("4", "Parts of one large upload sent at the same time"),
+        "line_index_size": ("1000", "Printed messages per chat that edits and deletions can update in place"),
+        "read_ack_interval": ("3", "Seconds between batched read acknowledgements"),
+        "nicklist_max": ("500", "Max members loaded into a group nicklist"),
+        "participants_ttl": ("600", "Seconds a group's cached member list stays valid"),
+        "highlight_words": ("", "Comma separated words or phrases that highlight a message, in addition to your names"),
+        "log_level": ("info", "Log file level: debug, info, warning or error"),
+        "log_max_kb": ("1024", "Rotate telegram.log at this size (0 never rotates)"),
+        "log_backups": ("3", "Rotated log files kept"),
+        "log_redact": ("on", "Hide message text, login codes and API hash in the log (on/off)")
     }
     for key, (val, desc) in defaults.items():
         if not weechat.config_is_set_plugin(key):
             weechat.config_set_plugin(key, val)
             weechat.config_set_desc_plugin(key, desc)
+        options[key] = weechat.config_get_plugin(key)
+
+def get_option(key):
+    """Plugin option as a string, from the mirror kept by option_config_cb.
+
+    The WeeChat API is only safe on the main thread, and the Python plugin
+    resolves config_get_plugin through the script running at the moment, so
+    code on the loop thread must never call it directly.
+    """
+    return options.get(key, "")
+
+# --- Main thread bridge ----------------------------------------------------
+
+def _wakeup():
+    try:
+        os.write(wakeup_w, b'\0')
+    except BlockingIOError:
+        pass  # Pipe full: a wakeup is already pending
+
+def call_main(func, *args):
+    """Run func(*args) on the WeeChat main thread, from any thread."""
+    main_calls.put((func, args))
+    _wakeup()
+
+def prnt(buf, msg):
+    """weechat.prnt that is safe to call from the asyncio loop thread."""
+    if loop_thread is not None and loop_thread.ident == threading.get_ident():
+        call_main(weechat.prnt, buf, msg)
+    else:
+        weechat.prnt(buf, msg)
+
+def submit(coro, category="misc", desc=""):
+    """Schedule a coroutine on the loop thread and track its future."""
+    return tasks.submit(coro, category, desc)
+
+# --- Task registry ----------------------------------------------------------
+
+class TaskManager:
+    """In-flight coroutines by id; finished tasks drop out via done-callbacks."""
+
+    LIMIT_OPTIONS = {
+        "dialogs": "max_dialog_tasks",
+        "auth": "max_auth_tasks",
+        "download": "max_downloads",
+    }
+
+    def __init__(self):
+        self.tasks   = {}  # id -> (category, desc, future, started)
+        self.limits  = {}  # category -> asyncio.Semaphore, created on the loop thread
+        self.next_id = 1
+        self.lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    async def _run(self, coro, category, limit):
+        if not limit:
+            return await coro
+        sem = self.limits.get(category)
+        if sem is None:
+            sem = self.limits[category] = asyncio.Semaphore(limit)
+        try:
+            async with sem:
+                return await coro
+        finally:
+            coro.close()  # No-op once awaited; avoids a warning if cancelled while queued
+
+    def submit(self, coro, category, desc):
+        limit = 0
+        option = self.LIMIT_OPTIONS.get(category)
+        if option:
+            try:
+                limit = max(1, int(get_option(option)))
+            except ValueError:
+                limit = 1
+        with self.lock:
+            task_id = self.next_id
+            self.next_id += 1
+        future = asyncio.run_coroutine_threadsafe(self._run(coro, category, limit), loop)
+        with self.lock:
+            self.tasks[task_id] = (category, desc, future, time.monotonic())
+        future.add_done_callback(lambda f: self._done(task_id, f))
+        return future
+
+    def _done(self, task_id, future):
+        with self.lock:
+            category, desc, _, _ = self.tasks.pop(task_id, (None, "", None, 0))
+        if future.cancelled():
+            if logger:
+                logger.info("Task %s (%s %s) cancelled", task_id, category, desc)
+            return
+        exc = future.exception()
+        if exc is not None:
+            call_main(weechat.prnt, "", f"Telegram: task {task_id} ({category} {desc}) failed: {exc}")
+            if logger:
+                logger.error("Task %s (%s %s) failed: %r", task_id, category, desc, exc)
+
+    def list(self):
+        with self.lock:
+            items = sorted(self.tasks.items())
+        weechat.prnt("", f"Telegram: {len(items)} task(s) in flight:")
+        now = time.monotonic()
+        for task_id, (category, desc, _, started) in items:
+            weechat.prnt("", f" - [{task_id}] {category} {desc} ({now - started:.1f}s)")
+
+    def cancel(self, task_id):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+        if not entry:
+            weechat.prnt("", f"Telegram: no task {task_id}")
+            return
+        entry[2].cancel()
+        weechat.prnt("", f"Telegram: cancelling task {task_id}")
+
+    def cancel_all(self):
+        with self.lock:
+            futures = [entry[2] for entry in self.tasks.values()]
+        for future in futures:
+            future.cancel()
+
+# --- Delivery stats ---------------------------------------------------------
+
+class DeliveryStats:
+    """Latency from a Telethon update reaching _on_message to weechat.prnt."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+        self.last  = 0.0
+        self.slow  = 0  # deliveries that took a second or more
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds >= 1.0:
+            self.slow += 1
+
+    def summary(self):
+        avg = self.total / self.count if self.count else 0.0
+        return (f"{self.count} delivered, avg {avg * 1000:.1f} ms, last {self.last * 1000:.1f} ms, "
+                f"max {self.max * 1000:.1f} ms, {self.slow} over 1s, {manager.queue.qsize()} queued")
+
+# --- Session storage --------------------------------------------------------
+
+class BatchedSQLiteSession(SQLiteSession):
+    """Telethon's SQLite session in WAL mode, committing at most every flush_interval.
+
+    Telethon calls save() after entity and update-state writes; here that only
+    commits once the interval has passed, and flush() forces it. close() still
+    commits whatever is pending.
+    """
+
+    def __init__(self, session_id, flush_interval=5):
+        self.flush_interval = flush_interval
+        self.last_commit    = 0.0
+        super().__init__(session_id)
+        self.flush()
+        c = self._cursor()
+        c.execute("pragma journal_mode=wal")
+        c.execute("pragma synchronous=normal")
+        c.close()
+
+    def save(self):
+        now = time.monotonic()
+        if now - self.last_commit >= self.flush_interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        if self._conn is not None:
+            self._conn.commit()
+        self.last_commit = now or time.monotonic()
+
+def open_session(path):
+    try:
+        interval = max(0, int(get_option("session_flush_interval")))
+    except ValueError:
+        interval = 5
+    return BatchedSQLiteSession(path, interval)
+
+# --- Entity cache -----------------------------------------------------------
+
+def write_json_atomic(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def entity_record(entity):
+    if isinstance(entity, User):
+        kind = "user"
+    elif isinstance(entity, Channel) and entity.broadcast:
+        kind = "channel"
+    else:
+        kind = "group"
+    return {
+        "title": utils.get_display_name(entity),
+        "username": getattr(entity, 'username', None),
+        "access_hash": getattr(entity, 'access_hash', None),
+        "type": kind,
+    }
+
+class EntityCache:
+    """Per-account chat_id -> title/username/access_hash/type, persisted to disk.
+
+    At most limit records are kept; the least recently used are dropped first.
+    """
+
+    def __init__(self, phone, limit):
+        self.file      = os.path.join(CACHE_DIR, f"{phone}.entities.json")
+        self.limit     = limit
+        self.entities  = OrderedDict()  # str(chat_id) -> record, least recently used first
+        self.muted     = {}  # str(chat_id) -> mute_until timestamp, from dialog notify settings
+        self.refreshed = 0   # time.time() of the last full dialog download
+        self.dirty     = False
+        self.lock      = threading.Lock()
+        self.save_lock = threading.Lock()  # One writer of the file at a time
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.file):
+            return
+        try:
+            with open(self.file) as f:
+                data = json.load(f)
+            self.entities  = OrderedDict(data.get("entities", {}))
+            self._trim()
+            self.muted     = data.get("muted", {})
+            self.refreshed = data.get("refreshed", 0)
+        except Exception as e:
+            if logger:
+                logger.exception("Error loading entity cache %s: %s", self.file, e)
+
+    def _trim(self):
+        while len(self.entities) > self.limit:
+            self.entities.popitem(last=False)
+
+    def save(self):
+        """Write the cache if it changed; slow on big caches, so not on the main thread."""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = {"refreshed": self.refreshed, "entities": dict(self.entities), "muted": dict(self.muted)}
+                self.dirty = False
+            try:
+                write_json_atomic(self.file, data)
+            except Exception as e:
+                if logger:
+                    logger.exception("Error saving entity cache %s: %s", self.file, e)
+
+    def get(self, chat_id):
+        key = str(chat_id)
+        with self.lock:
+            record = self.entities.get(key)
+            if record is not None:
+                self.entities.move_to_end(key)
+        return record
+
+    def put(self, entity):
+        record = entity_record(entity)
+        key = str(utils.get_peer_id(entity))
+        with self.lock:
+            if self.entities.get(key) != record:
+                self.entities[key] = record
+                self.dirty = True
+                self._trim()
+            self.entities.move_to_end(key)
+        return record
+
+    def set_muted(self, chat_id, until):
+        key = str(chat_id)
+        with self.lock:
+            if until:
+                if self.muted.get(key) != until:
+                    self.muted[key] = until
+                    self.dirty = True
+            elif self.muted.pop(key, None) is not None:
+                self.dirty = True
+
+    def muted_until(self):
+        """chat_id -> mute_until of the chats muted right now."""
+        now = time.time()
+        return {int(cid): until for cid, until in list(self.muted.items()) if until > now}
+
+    def mark_refreshed(self):
+        with self.lock:
+            self.refreshed = time.time()
+            self.dirty = True
+
+    def stale(self, interval):
+        return time.time() - self.refreshed >= interval
+
+class ChatFilter:
+    """Compiled ingest policy of one account, checked before any other work.
+
+    Denied chats, and muted chats when skip_muted is on, are dropped unless
+    they are on the allow list.
+    """
+
+    def __init__(self):
+        self.drop    = frozenset()
+        self.expires = 0  # time.time() the earliest dropped mute runs out, 0 if none
+        self.dropped = 0
+        self.passed  = 0
+        self.by_chat = {}  # chat_id -> dropped count
+
+    def compile(self, account, muted):
+        allow = set(account.get("allow", []))
+        drop = set(account.get("deny", []))
+        if account.get("skip_muted"):
+            drop |= muted.keys()
+        self.drop = frozenset(drop - allow)
+        self.expires = min((until for cid, until in muted.items() if cid in self.drop), default=0)
+
+    def admits(self, chat_id):
+        if chat_id in self.drop:
+            self.dropped += 1
+            self.by_chat[chat_id] = self.by_chat.get(chat_id, 0) + 1
+            return False
+        self.passed += 1
+        return True
+
+class MessageStore:
+    """Local history of one chat, oldest first, appended to a JSONL file.
+
+    A message stored with "gap" set may have unknown messages between it and
+    the one before it; tail() never reads across such a gap.
+    """
+
+    def __init__(self, phone, chat_id, keep):
+        directory = os.path.join(CACHE_DIR, "history", phone)
+        os.makedirs(directory, exist_ok=True)
+        self.file     = os.path.join(directory, f"{chat_id}.jsonl")
+        self.keep     = keep
+        self.messages = []  # dicts with id, date, sender, text and optionally gap
+        self.lines    = 0   # lines in the file, to know when to compact
+        self.lock     = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.file):
+            return
+        try:
+            with open(self.file) as f:
+                for line in f:
+                    try:
+                        self.messages.append(json.loads(line))
+                    except ValueError:
+                        continue
+                    self.lines += 1
+        except Exception as e:
+            if logger:
+                logger.exception("Error loading history %s: %s", self.file, e)
+        self.messages = self.messages[-self.keep:]
+
+    @property
+    def max_id(self):
+        return self.messages[-1]["id"] if self.messages else 0
+
+    def id_below(self, msg_id):
+        """Id of the newest stored message older than msg_id, or 0."""
+        with self.lock:
+            index = bisect.bisect_left([m["id"] for m in self.messages], msg_id)
+            return self.messages[index - 1]["id"] if index else 0
+
+    def extend(self, messages, gap=False):
+        """Append messages (oldest first) newer than what is stored.
+
+        gap: messages may be missing between the stored ones and these.
+        """
+        with self.lock:
+            new = [m for m in messages if m["id"] > self.max_id]
+            if not new:
+                return
+            if gap and self.messages:
+                new[0]["gap"] = True
+            self.messages.extend(new)
+            self.messages = self.messages[-self.keep:]
+            if self.lines + len(new) > 2 * self.keep:
+                self._rewrite()
+                return
+            try:
+                self.lines += len(new)
+                with open(self.file, 'a') as f:
+                    f.writelines(json.dumps(m) + "\n" for m in new)
+            except Exception as e:
+                if logger:
+                    logger.exception("Error writing history %s: %s", self.file, e)
+
+    def insert_older(self, messages, before_id, gap):
+        """Store messages (oldest first) that directly precede before_id.
+
+        gap: the fetch stopped at its limit before reaching the next stored
+        message, so the oldest of these starts a new gap.
+        """
+        with self.lock:
+            ids = [m["id"] for m in self.messages]
+            index = bisect.bisect_left(ids, before_id)
+            known = set(ids)
+            older = [m for m in messages if m["id"] < before_id and m["id"] not in known]
+            if index < len(self.messages):
+                self.messages[index].pop("gap", None)
+            if older and gap and index:
+                older[0]["gap"] = True
+            self.messages[index:index] = older
+            self.messages = self.messages[-self.keep:]
+            self._rewrite()
+
+    def _rewrite(self):
+        self.lines = len(self.messages)
+        try:
+            tmp = f"{self.file}.tmp"
+            with open(tmp, 'w') as f:
+                f.writelines(json.dumps(m) + "\n" for m in self.messages)
+            os.replace(tmp, self.file)
+        except Exception as e:
+            if logger:
+                logger.exception("Error writing history %s: %s", self.file, e)
+
+    def tail(self, n):
+        """The last n messages, stopping early at a gap."""
+        with self.lock:
+            run = []
+            for m in reversed(self.messages):
+                if len(run) >= n:
+                    break
+                run.append(m)
+                if m.get("gap"):
+                    break
+            return run[::-1]
+
+def media_label(message):
+    """Placeholder for a media message, e.g. [photo #42] or [file a.pdf 120 KB #43]."""
+    if message.photo:
+        kind = "photo"
+    elif message.voice:
+        kind = f"voice {message.file.duration or 0}s"
+    elif message.sticker:
+        kind = f"sticker {message.file.emoji or ''}".rstrip()
+    elif message.file:
+        kind = f"file {message.file.name or message.file.mime_type} {(message.file.size or 0) // 1024} KB"
+    else:
+        kind = type(message.media).__name__
+    return f"[{kind} #{message.id}]"
+
+def message_text(message, text=None):
+    """Text of a message, with a media placeholder in front of any caption.
+
+    text replaces message.text, which is empty for raw messages no client
+    was attached to.
+    """
+    text = (message.text if text is None else text) or ''
+    if message.media and (message.photo or message.file):
+        return f"{media_label(message)} {text}".rstrip()
+    return text
+
+def formatted_text(client, message):
+    """What message.text would be for a raw message from an updates response."""
+    if client.parse_mode and message.message:
+        return client.parse_mode.unparse(message.message, message.entities)
+    return message.message or ''
+
+def media_key(message):
+    """Cache file name derived from Telegram's id for the file contents."""
+    if message.photo:
+        return f"photo-{message.photo.id}.jpg"
+    return f"doc-{message.document.id}{message.file.ext or ''}"
+
+class MediaCache:
+    """Downloaded media on disk, evicted least recently used over a size cap."""
+
+    def __init__(self, directory, cap_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.dir   = directory
+        self.cap   = cap_bytes
+        self.files = OrderedDict()  # name -> size, least recently used first
+        self.total = 0
+        self.lock  = threading.Lock()
+        entries = [e for e in os.scandir(directory) if e.is_file() and not e.name.endswith(".part")]
+        for entry in sorted(entries, key=lambda e: e.stat().st_atime):
+            self.files[entry.name] = entry.stat().st_size
+            self.total += entry.stat().st_size
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def lookup(self, name):
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+        path = self.path(name)
+        os.utime(path)
+        return path
+
+    def add(self, name):
+        size = os.path.getsize(self.path(name))
+        with self.lock:
+            self.total += size - self.files.pop(name, 0)
+            self.files[name] = size
+            while self.total > self.cap and len(self.files) > 1:
+                old, old_size = self.files.popitem(last=False)
+                self.total -= old_size
+                try:
+                    os.remove(self.path(old))
+                except OSError:
+                    pass
+                if logger:
+                    logger.debug("Evicted cached media %s (%s bytes)", old, old_size)
+        return self.path(name)
+
+class Transfers:
+    """Progress of running downloads/uploads, rendered by the telegram_transfers bar item."""
+
+    INTERVAL = 0.5  # seconds between bar item refreshes
+
+    def __init__(self):
+        self.active  = {}  # key -> (label, done, total)
+        self.updated = 0.0
+
+    def progress(self, key, label, done, total):
+        self.active[key] = (label, done, total)
+        now = time.monotonic()
+        if now - self.updated >= self.INTERVAL:
+            self.updated = now
+            call_main(weechat.bar_item_update, "telegram_transfers")
+
+    def finish(self, key):
+        self.active.pop(key, None)
+        call_main(weechat.bar_item_update, "telegram_transfers")
+
+    def render(self):
+        parts = []
+        for label, done, total in list(self.active.values()):
+            pct = done * 100 // total if total else 0
+            parts.append(f"{label} {pct}%")
+        return " ".join(parts)
+
+class SendQueue:
+    """Ordered outbound messages per chat for one account, retried on FloodWait."""
+
+    MAX_LENGTH = 4096  # Telegram message length limit
+
+    def __init__(self, phone, client, parallel, coalesce):
+        self.phone    = phone
+        self.client   = client
+        self.pending  = {}     # chat_id -> deque of texts
+        self.workers  = set()  # chat_ids with a running worker
+        self.sem      = asyncio.Semaphore(parallel)
+        self.coalesce = coalesce  # seconds, 0 disables
+
+    def put(self, chat_id, text):
+        self.pending.setdefault(chat_id, deque()).append(text)
+        if chat_id not in self.workers:
+            self.workers.add(chat_id)
+            submit(self._worker(chat_id), "sendq", f"{self.phone}:{chat_id}")
+
+    async def _worker(self, chat_id):
+        queue = self.pending[chat_id]
+        try:
+            async with self.sem:
+                while queue:
+                    if self.coalesce:
+                        await asyncio.sleep(self.coalesce)
+                    await self._send(chat_id, self._take(queue))
+        finally:
+            self.workers.discard(chat_id)
+            if not queue:
+                self.pending.pop(chat_id, None)
+
+    def _take(self, queue):
+        text = queue.popleft()
+        if self.coalesce:
+            while queue and len(text) + 1 + len(queue[0]) <= self.MAX_LENGTH:
+                text += "\n" + queue.popleft()
+        return text
+
+    async def _send(self, chat_id, text):
+        while True:
+            try:
+                await self.client.send_message(int(chat_id), text)
+                if logger:
+                    logger.info("Message sent to %s from %s", chat_id, self.phone)
+                return
+            except FloodWaitError as e:
+                queued = len(self.pending.get(chat_id, ()))
+                prnt("", f"Telegram: flood wait {e.seconds}s for {self.phone}:{chat_id}, {queued + 1} message(s) held")
+                if logger:
+                    logger.warning("FloodWait %ss sending to %s from %s", e.seconds, chat_id, self.phone)
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                prnt("", f"Telegram: failed to send message: {e}")
+                if logger:
+                    logger.exception("Send message error: %s", e)
+                return
+
+def msg_tag(msg_id):
+    """Tag carried by the printed line of a message, checked before it is rewritten."""
+    return f"telegram_msg_{msg_id}"
+
+def last_line(buf):
+    """Pointer to the last line printed in buf."""
+    own_lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buf, "own_lines")
+    return weechat.hdata_pointer(weechat.hdata_get("lines"), own_lines, "last_line")
+
+def first_of_last_lines(buf, count):
+    """Pointer to the first of the last count lines of buf."""
+    line = last_line(buf)
+    if count > 1 and line:
+        line = weechat.hdata_move(weechat.hdata_get("line"), line, 1 - count)
+    return line
+
+def lines_data_if_alive(buf, line, tag, count):
+    """line_data of the count lines from line on that buf still holds with tag.
+
+    WeeChat frees lines on /buffer clear and whenever a history limit is
+    reached, so a stored pointer is only followed once it is found in the
+    buffer's line list again; the tag rules out a new line that reused the
+    address. Returns [] when the first line is gone.
+    """
+    hdata_line = weechat.hdata_get("line")
+    hdata_data = weechat.hdata_get("line_data")
+    own_lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buf, "own_lines")
+    first = weechat.hdata_pointer(weechat.hdata_get("lines"), own_lines, "first_line")
+    if not first or not weechat.hdata_check_pointer(hdata_line, first, line):
+        return []
+    found = []
+    while line and len(found) < count:
+        data = weechat.hdata_pointer(hdata_line, line, "data")
+        tags = weechat.hdata_integer(hdata_data, data, "tags_count")
+        if not any(weechat.hdata_string(hdata_data, data, f"{i}|tags_array") == tag for i in range(tags)):
+            break
+        found.append(data)
+        line = weechat.hdata_pointer(hdata_line, line, "next_line")
+    return found
+
+class LineIndex:
+    """(chat_id, msg_id) -> printed WeeChat lines, bounded per chat.
+
+    A message spans one line per newline in its text; the first line and
+    the count are kept. Entries are dropped with their buffer, and the
+    stored pointers may outlive the lines themselves; see lines_data_if_alive.
+    """
+
+    OWNERS_SIZE = 20000  # non-channel msg_id -> chat_id entries per account
+
+    def __init__(self, size):
+        self.size   = size
+        self.chats  = {}  # (phone, chat_id) -> OrderedDict msg_id -> [first line, count, sender, text]
+        self.owners = {}  # phone -> OrderedDict msg_id -> chat_id, for deletions without a chat
+
+    def add(self, phone, chat_id, msg_id, line, count, sender, text):
+        lines = self.chats.setdefault((phone, chat_id), OrderedDict())
+        lines[msg_id] = [line, count, sender, text]
+        if len(lines) > self.size:
+            lines.popitem(last=False)
+        if not chat_id.startswith("-100"):
+            # Outside channels, message ids are unique per account
+            owners = self.owners.setdefault(phone, OrderedDict())
+            owners[msg_id] = chat_id
+            if len(owners) > self.OWNERS_SIZE:
+                owners.popitem(last=False)
+
+    def get(self, phone, chat_id, msg_id):
+        lines = self.chats.get((phone, chat_id))
+        return lines.get(msg_id) if lines else None
+
+    def discard(self, phone, chat_id, msg_id):
+        lines = self.chats.get((phone, chat_id))
+        if lines:
+            lines.pop(msg_id, None)
+
+    def chat_of(self, phone, msg_id):
+        owners = self.owners.get(phone)
+        return owners.get(msg_id) if owners else None
+
+    def drop_chat(self, phone, chat_id):
+        self.chats.pop((phone, chat_id), None)
+
+class HighlightMatcher:
+    """Keywords and phrases matched in one pass over a message's words.
+
+    Single words sit in a set and phrases are indexed by their first word,
+    so the cost per message depends on its length, not on how many
+    keywords are configured.
+    """
+
+    TOKEN = re.compile(r"\w+")
+
+    def __init__(self, keywords):
+        self.words   = set()
+        self.phrases = {}  # first word -> list of word tuples
+        for keyword in keywords:
+            tokens = tuple(self.TOKEN.findall(keyword.casefold()))
+            if len(tokens) == 1:
+                self.words.add(tokens[0])
+            elif tokens:
+                self.phrases.setdefault(tokens[0], []).append(tokens)
+
+    def match(self, text):
+        tokens = self.TOKEN.findall(text.casefold())
+        for i, token in enumerate(tokens):
+            if token in self.words:
+                return True
+            for phrase in self.phrases.get(token, ()):
+                if tuple(tokens[i:i + len(phrase)]) == phrase:
+                    return True
+        return False
+
+def highlight_keywords(me=None):
+    """Configured highlight words plus our own first name and username."""
+    words = [w.strip() for w in get_option("highlight_words").split(",") if w.strip()]
+    if me is not None:
+        words += [name for name in (me.first_name, me.username) if name]
+    return words
+
+class ParticipantCache:
+    """Group members per (phone, chat_id), shared by buffers, expiring after a TTL."""
+
+    def __init__(self, ttl):
+        self.ttl    = ttl
+        self.groups = {}  # (phone, chat_id) -> (fetched_at, {user_id: name})
+
+    def get(self, key):
+        entry = self.groups.get(key)
+        if entry and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def put(self, key, members):
+        self.groups[key] = (time.time(), members)
+
+    def update(self, key, user_id, name):
+        """Apply a join (name set) or leave (name None) to a cached list."""
+        entry = self.groups.get(key)
+        if entry is None:
+            return
+        if name:
+            entry[1][user_id] = name
+        else:
+            entry[1].pop(user_id, None)
+
+class SenderResolver:
+    """Coalesces sender cache misses into one get_entity call per short window."""
+
+    WINDOW = 0.05  # seconds to collect unknown ids before one lookup
+
+    def __init__(self, client, cache):
+        self.client     = client
+        self.cache      = cache
+        self.pending    = {}  # sender_id -> Future[record or None]
+        self.flush_task = None
+
+    async def resolve(self, sender_id):
+        fut = self.pending.get(sender_id)
+        if fut is None:
+            fut = self.pending[sender_id] = asyncio.get_running_loop().create_future()
+            if self.flush_task is None:
+                self.flush_task = asyncio.ensure_future(self._flush())
+        return await fut
+
+    async def _flush(self):
+        await asyncio.sleep(self.WINDOW)
+        batch, self.pending = self.pending, {}
+        self.flush_task = None
+        found = {}
+        users = {}  # sender_id -> InputUser known to the session
+        rest = []   # channels posting as themselves, and ids the session cannot resolve
+        for sender_id in batch:
+            try:
+                peer = await self.client.get_input_entity(sender_id)
+            except (ValueError, TypeError):
+                rest.append(sender_id)
+                continue
+            if isinstance(peer, types.InputPeerUser):
+                users[sender_id] = utils.get_input_user(peer)
+            else:
+                rest.append(sender_id)
+        if users:
+            try:
+                for user in await self.client(functions.users.GetUsersRequest(list(users.values()))):
+                    if isinstance(user, User):
+                        found[user.id] = self.cache.put(user)
+            except Exception as e:
+                if logger:
+                    logger.warning("Batched lookup of %s senders failed: %s", len(users), e)
+        for sender_id in rest + [i for i in users if i not in found]:
+            # One at a time, so an id that cannot be resolved does not fail the others
+            try:
+                found[sender_id] = self.cache.put(await self.client.get_entity(sender_id))
+            except Exception as e:
+                if logger:
+                    logger.debug("Sender %s not resolved: %s", sender_id, e)
+        if logger:
+            logger.debug("Resolved %s/%s senders, %s in one GetUsers", len(found), len(batch), len(users))
+        for sender_id, fut in batch.items():
+            if not fut.done():
+                fut.set_result(found.get(sender_id))
 
 # --- Account Manager --------------------------------------------------------
 
 class TelegramAccountManager:
+    CATCH_UP_BATCH = 100  # missed messages queued between wakeups
+    REFRESH_RETRY  = 300  # seconds before a failed dialog refresh is tried again
+    BACKOFF_BASE   = 5    # seconds before the first reconnect attempt, doubled per failure
+
     def __init__(self):
         self.clients      = {}  # phone -> TelegramClient
         self.buffers      = {}  # (phone, chat_id) -> buffer
+        self.buffer_keys  = {}  # buffer -> (phone, chat_id), reverse of self.buffers
         self.queue        = Queue()
         self.file         = os.path.join(CONFIG_DIR, "accounts.json")
         self.accounts     = self._load_accounts()
         self.pending_auth = {}  # phone -> TelegramClient during auth
+        self.stats        = DeliveryStats()
+        self.caches       = {}  # phone -> EntityCache
+        self.resolvers    = {}  # phone -> SenderResolver
+        self.send_queues  = {}  # phone -> SendQueue
+        self.stores       = {}  # (phone, chat_id) -> MessageStore, for open buffers
+        self.create_lock  = threading.Lock()  # caches and stores are created from both threads
+        self.live_min     = {}  # (phone, chat_id) -> first message id printed live in the open buffer
+        self.transfers    = Transfers()
+        self.lines        = LineIndex(self._line_index_size())
+        self.me           = {}  # phone -> own display name
+        self.filters      = {}  # phone -> ChatFilter
+        self.unread       = {}  # (phone, chat_id) -> [unread, mentions]
+        self.last_id      = {}  # (phone, chat_id) -> last message id printed
+        self.caught_up    = {}  # (phone, chat_id) -> last message id queued by catch-up, loop thread
+        self.hotlist_dirty = set()  # chats whose hotlist changed in the current batch
+        self.read_pending = {}  # (phone, chat_id) -> max_id to acknowledge in the next batch
+        self.nicklists    = set()  # chats whose nicklist was requested for the open buffer
+        try:
+            ttl = int(get_option("participants_ttl"))
+        except ValueError:
+            ttl = 600
+        self.participants = ParticipantCache(ttl)
+        self.matchers     = {}  # phone -> HighlightMatcher
+        self.me_users     = {}  # phone -> own User, for highlight keywords
+        self.wanted       = set()  # phones that should stay connected
+        self.groups       = {}  # (phone, chat_id, group) -> items waiting for the coalescing window
+        self.open_groups  = {}  # (phone, chat_id) -> group key currently collecting
+        self.chat_turns   = {}  # (phone, chat_id) -> Future done once the latest event is queued
+        self.coalesce     = 0.3  # seconds, read from coalesce_ms on connect
+        self.conn_state   = {}  # phone -> {"state", "attempts", "retry_at"}
+        self.refresh_next = {}  # phone -> monotonic time before which no dialog refresh starts
+        try:
+            cap = int(get_option("media_cache_mb")) * 1024 * 1024
+        except ValueError:
+            cap = 500 * 1024 * 1024
+        self.media        = MediaCache(os.path.join(CACHE_DIR, "media"), cap)
 
     def _load_accounts(self):
         if os.path.isfile(self.file):
@@ -77,7 +1021,7 @@ class TelegramAccountManager:
                 if logger:
                     logger.exception("Error loading accounts: %s", e)
                 else:
-                    weechat.prnt("", f"Telegram: Error loading accounts: {e}")
+                    prnt("", f"Telegram: Error loading accounts: {e}")
         return {}
 
     def _save_accounts(self):
@@ -90,17 +1034,17 @@ class TelegramAccountManager:
             if logger:
                 logger.exception("Error saving accounts: %s", e)
             else:
-                weechat.prnt("", f"Telegram: Error saving accounts: {e}")
+                prnt("", f"Telegram: Error saving accounts: {e}")
 
     async def add(self, phone):
         if logger:
-            logger.debug(f"Attempting to add phone: {phone}")
-        api_id = weechat.config_get_plugin("api_id")
-        api_hash = weechat.config_get_plugin("api_hash")
+            logger.debug("Attempting to add phone: %s", phone)
+        api_id = get_option("api_id")
+        api_hash = get_option("api_hash")
         if logger:
-            logger.debug(f"API ID: {api_id}, API Hash: {api_hash}")
+            logger.debug("API ID: %s, API Hash: %s", api_id, Redacted(api_hash))
         if not api_id or not api_hash:
-            weechat.prnt("", "Telegram: set api_id & api_hash first")
+            prnt("", "Telegram: set api_id & api_hash first")
             if logger:
                 logger.error("API ID or API Hash not set")
             return
@@ -108,7 +1052,7 @@ class TelegramAccountManager:
         try:
             api_id = int(api_id)
         except ValueError:
-            weechat.prnt("", "Telegram: api_id must be a number")
+            prnt("", "Telegram: api_id must be a number")
             if logger:
                 logger.error("Invalid api_id: not a number")
             return
@@ -117,426 +1061,1634 @@ class TelegramAccountManager:
         client = None
         try:
             if logger:
-                logger.debug(f"Creating TelegramClient for session: {session}")
-            client = TelegramClient(session, api_id, api_hash)
+                logger.debug("Creating TelegramClient for session: %s", session)
+            client = TelegramClient(open_session(session), api_id, api_hash)
             if not client:
-                weechat.prnt("", f"Telegram: failed to create client for {phone}")
+                prnt("", f"Telegram: failed to create client for {phone}")
                 if logger:
-                    logger.error(f"Failed to create TelegramClient for {phone}")
+                    logger.error("Failed to create TelegramClient for %s", phone)
                 return
             if logger:
-                logger.debug(f"Connecting to Telegram for phone {phone}")
+                logger.debug("Connecting to Telegram for phone %s", phone)
             await client.connect()
             if logger:
-                logger.info(f"Connected to Telegram for phone {phone}")
+                logger.info("Connected to Telegram for phone %s", phone)
         except Exception as e:
-            weechat.prnt("", f"Telegram: failed to connect for {phone}: {e}")
+            prnt("", f"Telegram: failed to connect for {phone}: {e}")
             if logger:
-                logger.exception(f"Connection error for {phone}: {e}")
+                logger.exception("Connection error for %s: %s", phone, e)
             return
 
         try:
             if logger:
-                logger.debug(f"Sending code request to {phone}")
+                logger.debug("Sending code request to %s", phone)
             await client.send_code_request(phone)
             if logger:
-                logger.info(f"Code request sent to {phone}")
-            weechat.prnt("", f"Telegram: code sent to {phone}, run /telegram code {phone} <CODE>")
+                logger.info("Code request sent to %s", phone)
+            prnt("", f"Telegram: code sent to {phone}, run /telegram code {phone} <CODE>")
             self.pending_auth[phone] = client
         except Exception as e:
-            weechat.prnt("", f"Telegram: failed to send code to {phone}: {e}")
+            prnt("", f"Telegram: failed to send code to {phone}: {e}")
             if logger:
-                logger.exception(f"Code request error for {phone}: {e}")
+                logger.exception("Code request error for %s: %s", phone, e)
             if client:
                 await client.disconnect()
             return
 
     async def code(self, phone, code):
         if logger:
-            logger.debug(f"Processing code for phone: {phone}, code: {code}")
+            logger.debug("Processing code for phone: %s, code: %s", phone, Redacted(code))
         client = self.pending_auth.get(phone)
         if not client:
-            weechat.prnt("", f"Telegram: no pending auth for {phone}")
+            prnt("", f"Telegram: no pending auth for {phone}")
             if logger:
-                logger.error(f"No pending auth for {phone}")
+                logger.error("No pending auth for %s", phone)
             return
         try:
             await client.sign_in(phone, code)
             if logger:
-                logger.info(f"Successful sign-in for {phone}")
+                logger.info("Successful sign-in for %s", phone)
         except SessionPasswordNeededError:
-            weechat.prnt("", f"Telegram: account has 2FA, enter password with /telegram password {phone} <password>")
+            prnt("", f"Telegram: account has 2FA, enter password with /telegram password {phone} <password>")
             if logger:
-                logger.info(f"2FA required for {phone}")
+                logger.info("2FA required for %s", phone)
             return
         except Exception as e:
-            weechat.prnt("", f"Telegram: sign_in failed: {e}")
+            prnt("", f"Telegram: sign_in failed: {e}")
             if logger:
-                logger.exception(f"Auth code error for {phone}: {e}")
+                logger.exception("Auth code error for %s: %s", phone, e)
             await client.disconnect()
             self.pending_auth.pop(phone, None)
             return
 
         self.accounts[phone] = {"session": os.path.basename(client.session.filename)}
         self._save_accounts()
-        weechat.prnt("", f"Telegram: account {phone} authenticated and saved")
+        prnt("", f"Telegram: account {phone} authenticated and saved")
         await client.disconnect()
         self.pending_auth.pop(phone, None)
 
     async def password(self, phone, password):
         if logger:
-            logger.debug(f"Processing password for phone: {phone}")
+            logger.debug("Processing password for phone: %s", phone)
         client = self.pending_auth.get(phone)
         if not client:
-            weechat.prnt("", f"Telegram: no pending auth for {phone}")
+            prnt("", f"Telegram: no pending auth for {phone}")
             if logger:
-                logger.error(f"No pending auth for {phone}")
+                logger.error("No pending auth for %s", phone)
             return
         try:
             await client.sign_in(password=password)
             if logger:
-                logger.info(f"Successful 2FA sign-in for {phone}")
+                logger.info("Successful 2FA sign-in for %s", phone)
         except Exception as e:
-            weechat.prnt("", f"Telegram: password auth failed: {e}")
+            prnt("", f"Telegram: password auth failed: {e}")
             if logger:
-                logger.exception(f"Password auth error for {phone}: {e}")
+                logger.exception("Password auth error for %s: %s", phone, e)
             await client.disconnect()
             self.pending_auth.pop(phone, None)
             return
 
         self.accounts[phone] = {"session": os.path.basename(client.session.filename)}
         self._save_accounts()
-        weechat.prnt("", f"Telegram: account {phone} authenticated and saved")
+        prnt("", f"Telegram: account {phone} authenticated and saved")
         await client.disconnect()
         self.pending_auth.pop(phone, None)
 
     async def connect(self, phone):
         if logger:
-            logger.debug(f"Attempting to connect phone: {phone}")
+            logger.debug("Attempting to connect phone: %s", phone)
         if phone not in self.accounts:
-            weechat.prnt("", f"Telegram: no account {phone}")
+            prnt("", f"Telegram: no account {phone}")
             if logger:
-                logger.error(f"No account found for {phone}")
+                logger.error("No account found for %s", phone)
             return
         if phone in self.clients:
-            weechat.prnt("", f"Telegram: already connected {phone}")
+            prnt("", f"Telegram: already connected {phone}")
             if logger:
-                logger.info(f"Already connected: {phone}")
+                logger.info("Already connected: %s", phone)
             return
 
-        api_id = weechat.config_get_plugin("api_id")
-        api_hash = weechat.config_get_plugin("api_hash")
+        self.wanted.add(phone)
+        self._set_state(phone, "connecting")
+        api_id = get_option("api_id")
+        api_hash = get_option("api_hash")
         session = os.path.join(SESSION_DIR, self.accounts[phone]["session"])
+        client = None
         try:
-            client = TelegramClient(session, int(api_id), api_hash)
+            client = TelegramClient(open_session(session), int(api_id), api_hash)
             await client.connect()
             if not await client.is_user_authorized():
-                weechat.prnt("", f"Telegram: re-auth needed for {phone}")
+                prnt("", f"Telegram: re-auth needed for {phone}")
                 if logger:
-                    logger.error(f"Re-auth needed for {phone}")
+                    logger.error("Re-auth needed for %s", phone)
+                self.wanted.discard(phone)
+                self._set_state(phone, "unauthorized")
                 await client.disconnect()
                 return
             client._phone = phone
-            client.add_event_handler(self._on_message, NewMessage(incoming=True))
+            try:
+                self.coalesce = max(0, int(get_option("coalesce_ms"))) / 1000
+            except ValueError:
+                self.coalesce = 0.3
+            self.compile_filter(phone)
+            self.resolvers[phone] = SenderResolver(client, self.cache(phone))
+            self.send_queues[phone] = self._send_queue(phone, client)
+            me = await client.get_me()
+            self.me[phone] = utils.get_display_name(me)
+            self.me_users[phone] = me
+            self.matchers[phone] = HighlightMatcher(highlight_keywords(me))
+            client.add_event_handler(self._on_message, NewMessage())
+            client.add_event_handler(self._on_edit, MessageEdited())
+            client.add_event_handler(self._on_delete, MessageDeleted())
+            client.add_event_handler(self._on_chat_action, ChatAction())
             self.clients[phone] = client
-            weechat.prnt("", f"Telegram: connected {phone}")
+            self._set_state(phone, "connected")
+            prnt("", f"Telegram: connected {phone}")
             if logger:
-                logger.info(f"Connected: {phone}")
+                logger.info("Connected: %s", phone)
+            self._refresh_if_stale(phone)
+            submit(self.catch_up(phone, client), "connect", f"{phone} catch-up")
         except Exception as e:
-            weechat.prnt("", f"Telegram: failed to connect {phone}: {e}")
+            prnt("", f"Telegram: failed to connect {phone}: {e}")
             if logger:
-                logger.exception(f"Connect error for {phone}: {e}")
+                logger.exception("Connect error for %s: %s", phone, e)
+            if client and phone not in self.clients:
+                await client.disconnect()
+            self._backoff(phone)
+
+    def _set_state(self, phone, state, **fields):
+        entry = self.conn_state.setdefault(phone, {"state": state, "attempts": 0, "retry_at": 0})
+        changed = entry["state"] != state
+        entry["state"] = state
+        entry.update(fields)
+        if state == "connected":
+            entry["attempts"] = 0
+        if changed:
+            call_main(weechat.bar_item_update, "telegram_status")
+
+    def _backoff(self, phone):
+        """Schedule the next reconnect with exponential backoff and per-account jitter."""
+        entry = self.conn_state.get(phone) or {"attempts": 0}
+        attempts = entry["attempts"] + 1
+        try:
+            cap = int(get_option("reconnect_max_backoff"))
+        except ValueError:
+            cap = 300
+        delay = min(cap, self.BACKOFF_BASE * 2 ** (attempts - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)  # accounts never retry in lockstep
+        self._set_state(phone, "backoff", attempts=attempts, retry_at=time.monotonic() + delay)
+        if logger:
+            logger.info("Reconnect of %s in %.1fs (attempt %s)", phone, delay, attempts)
+
+    async def supervise(self):
+        """Watch wanted accounts and reconnect dropped or failed clients.
+
+        Also recompiles filters whose mutes ran out and refreshes dialog
+        lists older than dialog_refresh_interval.
+        """
+        next_check = 0
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            if now >= next_check:
+                try:
+                    interval = max(1, int(get_option("reconnect_interval")))
+                except ValueError:
+                    interval = 30
+                next_check = now + interval
+                for phone in list(self.wanted):
+                    self._refresh_if_stale(phone)
+                    client = self.clients.get(phone)
+                    state = self.conn_state.get(phone, {}).get("state")
+                    if client and client.is_connected():
+                        if state != "connected":
+                            self._set_state(phone, "connected")
+                    elif state == "connected":
+                        prnt("", f"Telegram: lost connection for {phone}")
+                        self._backoff(phone)
+            for phone, chat_filter in list(self.filters.items()):
+                if chat_filter.expires and time.time() >= chat_filter.expires:
+                    self.compile_filter(phone)  # A mute ran out: admit that chat again
+            for phone in list(self.wanted):
+                entry = self.conn_state.get(phone)
+                if entry and entry["state"] == "backoff" and now >= entry["retry_at"]:
+                    self._set_state(phone, "reconnecting")
+                    submit(self._reconnect(phone), "connect", f"{phone} reconnect")
+
+    async def _reconnect(self, phone):
+        client = self.clients.get(phone)
+        if client is None:
+            await self.connect(phone)
+            return
+        try:
+            await client.connect()
+        except Exception as e:
+            if logger:
+                logger.warning("Reconnect of %s failed: %s", phone, e)
+        if phone not in self.wanted:
+            return
+        if client.is_connected():
+            self._set_state(phone, "connected")
+            prnt("", f"Telegram: reconnected {phone}")
+            submit(self.catch_up(phone, client), "connect", f"{phone} catch-up")
+        else:
+            self._backoff(phone)
+
+    def status(self):
+        """Compact per-account connection state for the telegram_status bar item."""
+        parts = []
+        for phone in self.accounts:
+            entry = self.conn_state.get(phone)
+            if not entry:
+                continue
+            state = entry["state"]
+            if state == "backoff":
+                state = f"retry#{entry['attempts']}"
+            parts.append(f"{phone}:{state}")
+        return " ".join(parts)
+
+    async def autoconnect(self, parallel):
+        """Connect every saved account concurrently, at most parallel at a time."""
+        start = time.monotonic()
+        sem = asyncio.Semaphore(parallel)
+
+        async def connect_one(phone):
+            async with sem:
+                began = time.monotonic()
+                await self.connect(phone)
+                ok = phone in self.clients
+                prnt("", f"Telegram: autoconnect {phone} {'ok' if ok else 'failed'} ({time.monotonic() - began:.1f}s)")
+                return ok
+
+        phones = list(self.accounts)
+        results = await asyncio.gather(*(connect_one(ph) for ph in phones))
+        elapsed = time.monotonic() - start
+        prnt("", f"Telegram: autoconnect finished, {sum(results)}/{len(phones)} accounts in {elapsed:.1f}s")
+        if logger:
+            logger.info("Autoconnect: %s/%s accounts in %.3fs", sum(results), len(phones), elapsed)
 
     async def disconnect(self, phone):
         if logger:
-            logger.debug(f"Disconnecting phone: {phone}")
+            logger.debug("Disconnecting phone: %s", phone)
+        self.wanted.discard(phone)
+        self._set_state(phone, "disconnected")
         client = self.clients.pop(phone, None)
+        self.resolvers.pop(phone, None)
+        self.send_queues.pop(phone, None)
         if client:
+            await self.save_update_state(phone, client)
             await client.disconnect()
-            weechat.prnt("", f"Telegram: disconnected {phone}")
+            prnt("", f"Telegram: disconnected {phone}")
             if logger:
-                logger.info(f"Disconnected: {phone}")
+                logger.info("Disconnected: %s", phone)
+
+    def _state_file(self, phone):
+        return os.path.join(CACHE_DIR, f"{phone}.state.json")
+
+    async def save_update_state(self, phone, client):
+        """Remember pts/qts/date so the next connect can fetch what was missed."""
+        try:
+            state = await client(functions.updates.GetStateRequest())
+            write_json_atomic(self._state_file(phone), {
+                "pts": state.pts,
+                "qts": state.qts,
+                "date": int(state.date.timestamp()),
+                "seq": state.seq,
+            })
+        except Exception as e:
+            if logger:
+                logger.exception("Error saving update state for %s: %s", phone, e)
+
+    async def save_caches(self):
+        """Write changed entity caches from an executor, off the WeeChat main thread."""
+        running = asyncio.get_running_loop()
+        for cache in list(self.caches.values()):
+            await running.run_in_executor(None, cache.save)
+
+    async def save_update_states(self):
+        for phone, client in list(self.clients.items()):
+            await self.save_update_state(phone, client)
+            client.session.flush()
+
+    async def catch_up(self, phone, client):
+        """Deliver messages missed since the saved update state via getDifference."""
+        try:
+            with open(self._state_file(phone)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        pts, qts, date = state["pts"], state["qts"], state["date"]
+        delivered = 0
+        too_long = set()  # channels getDifference only flags, their messages are not included
+        while True:
+            diff = await client(functions.updates.GetDifferenceRequest(
+                pts=pts, qts=qts, date=datetime.fromtimestamp(date, timezone.utc)))
+            if isinstance(diff, types.updates.DifferenceEmpty):
+                break
+            if isinstance(diff, types.updates.DifferenceTooLong):
+                prnt("", f"Telegram: {phone} missed too many updates, use /telegram history in the chats you need")
+                break
+            delivered += self._deliver_difference(phone, client, diff)
+            too_long.update(u.channel_id for u in diff.other_updates if isinstance(u, types.UpdateChannelTooLong))
+            if isinstance(diff, types.updates.DifferenceSlice):
+                new_state = diff.intermediate_state
+            else:
+                new_state = diff.state
+            pts, qts, date = new_state.pts, new_state.qts, int(new_state.date.timestamp())
+            if isinstance(diff, types.updates.Difference):
+                break
+        if too_long:
+            delivered += await self.catch_up_channels(phone, client, too_long)
+        if delivered:
+            prnt("", f"Telegram: {phone} caught up {delivered} missed message(s)")
+        if logger:
+            logger.info("Catch-up for %s: %s messages, %s channels too long", phone, delivered, len(too_long))
+
+    async def catch_up_channels(self, phone, client, channel_ids):
+        """Fetch what supergroups and channels got since the last message we know of.
+
+        Chats with no known message, or more missed than one batch, are
+        named to the user so they can page through them with /telegram history.
+        """
+        gaps = []
+        delivered = 0
+        for channel_id in channel_ids:
+            cid = str(utils.get_peer_id(types.PeerChannel(channel_id)))
+            if int(cid) in self.filters[phone].drop:
+                continue
+            known = max(self.last_id.get((phone, cid), 0), self.stored_max_id(phone, cid))
+            if not known:
+                gaps.append(cid)
+                continue
+            try:
+                messages = await client.get_messages(int(cid), limit=self.CATCH_UP_BATCH + 1, min_id=known)
+            except Exception as e:
+                if logger:
+                    logger.warning("Catch-up of %s:%s failed: %s", phone, cid, e)
+                gaps.append(cid)
+                continue
+            if len(messages) > self.CATCH_UP_BATCH:
+                gaps.append(cid)
+                messages = messages[:self.CATCH_UP_BATCH]
+            for msg in messages:
+                if msg.sender:
+                    self.cache(phone).put(msg.sender)
+            delivered += self._queue_missed(phone, reversed(messages))
+        if gaps:
+            cache = self.cache(phone)
+            names = ", ".join((cache.get(cid) or {}).get("title") or cid for cid in gaps)
+            prnt("", f"Telegram: {phone} may have missed messages in {names}, use /telegram history there")
+        return delivered
+
+    def _deliver_difference(self, phone, client, diff):
+        """Queue the new messages of one difference, oldest first."""
+        cache = self.cache(phone)
+        for entity in diff.users + diff.chats:
+            cache.put(entity)
+        messages = sorted(
+            (m for m in diff.new_messages if isinstance(m, types.Message)),
+            key=lambda m: (m.date, m.id))
+        return self._queue_missed(phone, messages, lambda m: formatted_text(client, m))
+
+    def _queue_missed(self, phone, messages, text_of=lambda m: None):
+        """Queue caught-up messages, oldest first, as live ones would be."""
+        cache = self.cache(phone)
+        received = time.monotonic()
+        queued = 0
+        for msg in messages:
+            cid = str(utils.get_peer_id(msg.peer_id))
+            key = (phone, cid)
+            # The saved state lags up to a minute behind, so a reconnect fetches
+            # messages that were printed, or queued by an earlier catch-up, already
+            if msg.id <= max(self.last_id.get(key, 0), self.caught_up.get(key, 0)):
+                continue
+            if not self.filters[phone].admits(int(cid)):
+                continue
+            self.caught_up[key] = msg.id
+            text = message_text(msg, text_of(msg))
+            if not text:
+                continue
+            record = cache.get(msg.sender_id) or cache.get(cid)
+            if msg.out:
+                sender = self.me.get(phone) or str(msg.sender_id)
+            else:
+                sender = (record["title"] or record["username"]) if record else str(msg.sender_id or cid)
+            highlight = not msg.out and (msg.mentioned or self.matchers[phone].match(text))
+            self.queue.put(("message", phone, cid, msg.id, sender, text, received, (msg.out, highlight)))
+            queued += 1
+            if queued % self.CATCH_UP_BATCH == 0:
+                _wakeup()
+        _wakeup()
+        return queued
 
     def list(self):
-        weechat.prnt("", "Telegram: connected accounts:")
-        for ph in self.clients:
-            weechat.prnt("", f" - {ph}")
+        prnt("", "Telegram: accounts:")
+        now = time.monotonic()
+        for ph in self.accounts:
+            entry = self.conn_state.get(ph, {"state": "disconnected", "attempts": 0})
+            line = f" - {ph}: {entry['state']}"
+            if entry["state"] == "backoff":
+                line += f", attempt {entry['attempts']}, next in {max(0, entry['retry_at'] - now):.0f}s"
+            prnt("", line)
+
+    def _send_queue(self, phone, client):
+        try:
+            parallel = max(1, int(get_option("max_send_tasks")))
+        except ValueError:
+            parallel = 4
+        try:
+            coalesce = max(0, int(get_option("send_coalesce_ms"))) / 1000
+        except ValueError:
+            coalesce = 0
+        return SendQueue(phone, client, parallel, coalesce)
+
+    def _line_index_size(self):
+        try:
+            size = int(get_option("line_index_size"))
+        except ValueError:
+            size = 1000
+        max_lines = weechat.config_integer(weechat.config_get("weechat.history.max_buffer_lines_number"))
+        if max_lines > 0:
+            size = min(size, max_lines)  # Older lines are gone anyway
+        return max(1, size)
+
+    def compile_filter(self, phone):
+        chat_filter = self.filters.get(phone)
+        if chat_filter is None:
+            chat_filter = self.filters[phone] = ChatFilter()
+        chat_filter.compile(self.accounts.get(phone, {}), self.cache(phone).muted_until())
+        return chat_filter
+
+    def set_filter(self, phone, action, chat_id=None):
+        """Edit the allow/deny lists or the muted policy of an account."""
+        account = self.accounts.get(phone)
+        if account is None:
+            weechat.prnt("", f"Telegram: no account {phone}")
+            return
+        if action in ("allow", "deny", "unallow", "undeny"):
+            name = action[2:] if action.startswith("un") else action
+            ids = set(account.get(name, []))
+            if action.startswith("un"):
+                ids.discard(chat_id)
+            else:
+                ids.add(chat_id)
+            account[name] = sorted(ids)
+        elif action in ("muted", "unmuted"):
+            account["skip_muted"] = action == "muted"
+        self._save_accounts()
+        chat_filter = self.compile_filter(phone)
+        weechat.prnt("", f"Telegram: {phone} filter: allow {account.get('allow', [])}, "
+                         f"deny {account.get('deny', [])}, skip muted {'on' if account.get('skip_muted') else 'off'}, "
+                         f"{len(chat_filter.drop)} chats dropped")
+
+    def filter_stats(self, phone):
+        chat_filter = self.filters.get(phone) or self.compile_filter(phone)
+        total = chat_filter.dropped + chat_filter.passed
+        pct = chat_filter.dropped * 100 / total if total else 0
+        weechat.prnt("", f"Telegram: {phone} dropped {chat_filter.dropped}/{total} updates ({pct:.0f}%) "
+                         f"from {len(chat_filter.drop)} filtered chats")
+        top = sorted(chat_filter.by_chat.items(), key=lambda kv: kv[1], reverse=True)[:10]
+        for chat_id, count in top:
+            record = self.cache(phone).get(chat_id)
+            weechat.prnt("", f"  {record['title'] if record else chat_id} ({chat_id}): {count}")
+
+    def cache(self, phone):
+        cache = self.caches.get(phone)
+        if cache is None:
+            try:
+                limit = max(1, int(get_option("entity_cache_size")))
+            except ValueError:
+                limit = 10000
+            with self.create_lock:
+                cache = self.caches.get(phone)
+                if cache is None:
+                    cache = self.caches[phone] = EntityCache(phone, limit)
+        return cache
+
+    def _refresh_interval(self):
+        try:
+            return int(get_option("dialog_refresh_interval"))
+        except ValueError:
+            return 3600
+
+    def _refresh_if_stale(self, phone):
+        """Refresh the dialog list in the background once it is dialog_refresh_interval old."""
+        client = self.clients.get(phone)
+        if not client or not client.is_connected() or time.monotonic() < self.refresh_next.get(phone, 0):
+            return
+        if self.cache(phone).stale(self._refresh_interval()):
+            self.refresh_next[phone] = float("inf")  # Until this refresh finishes
+            submit(self.refresh_dialogs(phone), "dialogs", f"{phone} refresh")
 
-    async def dialogs(self, phone=None):
+    async def refresh_dialogs(self, phone):
+        """Download the dialog list once and fold it into the entity cache."""
+        client = self.clients.get(phone)
+        if not client:
+            self.refresh_next.pop(phone, None)
+            return
+        cache = self.cache(phone)
+        count = 0
+        seeds = []
+        retry_at = time.monotonic() + self.REFRESH_RETRY
+        try:
+            async for dlg in client.iter_dialogs():
+                cache.put(dlg.entity)
+                mute_until = dlg.dialog.notify_settings.mute_until
+                cache.set_muted(dlg.id, int(mute_until.timestamp()) if mute_until else 0)
+                seeds.append((str(dlg.id), dlg.unread_count, dlg.unread_mentions_count))
+                count += 1
+            retry_at = 0  # Done: the next refresh waits for dialog_refresh_interval
+        finally:
+            self.refresh_next[phone] = retry_at
+        call_main(self.seed_unread, phone, seeds)
+        cache.mark_refreshed()
+        await asyncio.get_running_loop().run_in_executor(None, cache.save)
+        self.compile_filter(phone)
+        if logger:
+            logger.info("Dialog cache refreshed for %s: %s dialogs", phone, count)
+
+    DIALOG_BATCH = 50  # dialog lines printed per main thread call
+
+    def seed_unread(self, phone, seeds):
+        """Set unread/mention counters from dialog metadata; runs on the main thread."""
+        for chat_id, unread, mentions in seeds:
+            key = (phone, chat_id)
+            if unread:
+                self.unread[key] = [unread, mentions]
+                self.hotlist_dirty.add(key)
+            else:
+                self.unread.pop(key, None)
+        self.flush_hotlist()
+
+    async def dialogs(self, phone=None, limit=100, kind=None, unread=False):
+        """Stream matching dialogs into the telegram.dialogs buffer as pages arrive."""
         if logger:
-            logger.debug(f"Listing dialogs for phone: {phone}")
+            logger.debug("Listing dialogs for phone: %s, limit=%s, type=%s, unread=%s", phone, limit, kind, unread)
         phones = [phone] if phone and phone in self.clients else list(self.clients)
         for ph in phones:
             client = self.clients[ph]
+            cache = self.cache(ph)
+            call_main(self._print_dialogs, [f"Dialogs for {ph}:"])
+            batch = []
+            seeds = []
+            listed = 0
             try:
-                chats = await client.get_dialogs()
-                weechat.prnt("", f"Dialogs for {ph}:")
-                for dlg in chats:
-                    weechat.prnt("", f"  {dlg.title or dlg.name} ({dlg.id})")
+                # iter_dialogs fetches pages lazily, so stopping early skips the rest
+                async for dlg in client.iter_dialogs(ignore_migrated=True):
+                    cache.put(dlg.entity)
+                    seeds.append((str(dlg.id), dlg.unread_count, dlg.unread_mentions_count))
+                    if kind == "user" and not dlg.is_user:
+                        continue
+                    if kind == "group" and not dlg.is_group:
+                        continue
+                    if kind == "channel" and (dlg.is_group or not dlg.is_channel):
+                        continue
+                    if unread and not dlg.unread_count:
+                        continue
+                    line = f"  {dlg.title or dlg.name} ({dlg.id})"
+                    if dlg.unread_count:
+                        line += f" [{dlg.unread_count} unread]"
+                    batch.append(line)
+                    listed += 1
+                    if len(batch) >= self.DIALOG_BATCH:
+                        call_main(self._print_dialogs, batch)
+                        batch = []
+                    if limit and listed >= limit:
+                        break
+                batch.append(f"  {listed} dialog(s) listed")
+                call_main(self._print_dialogs, batch)
+                call_main(self.seed_unread, ph, seeds)
             except Exception as e:
-                weechat.prnt("", f"Telegram: failed to get dialogs for {ph}: {e}")
+                prnt("", f"Telegram: failed to get dialogs for {ph}: {e}")
                 if logger:
-                    logger.exception(f"Dialogs error for {ph}: {e}")
+                    logger.exception("Dialogs error for %s: %s", ph, e)
+
+    def _print_dialogs(self, lines):
+        buf = weechat.buffer_search("python", "telegram.dialogs")
+        if not buf:
+            buf = weechat.buffer_new("telegram.dialogs", "", "", "", "")
+            weechat.buffer_set(buf, "title", "Telegram dialogs")
+        weechat.prnt(buf, "\n".join(lines))
+
+    def store(self, phone, chat_id):
+        """History store of a chat with an open buffer; dropped when the buffer closes."""
+        key = (phone, chat_id)
+        with self.create_lock:
+            store = self.stores.get(key)
+            if store is None:
+                store = self.stores[key] = self._new_store(phone, chat_id)
+        return store
+
+    def stored_max_id(self, phone, chat_id):
+        """Newest stored message id of a chat, without keeping its store loaded."""
+        store = self.stores.get((phone, chat_id)) or self._new_store(phone, chat_id)
+        return store.max_id
+
+    def _new_store(self, phone, chat_id):
+        try:
+            keep = int(get_option("history_keep"))
+        except ValueError:
+            keep = 1000
+        return MessageStore(phone, chat_id, keep)
+
+    async def _fetch_history(self, client, phone, chat_id, limit, **kwargs):
+        """Up to limit messages of a chat as store records, oldest first."""
+        cache = self.cache(phone)
+        fetched = []
+        # iter_messages pages through GetHistory 100 messages per request
+        async for msg in client.iter_messages(int(chat_id), limit=limit, **kwargs):
+            if msg.sender:
+                sender = cache.put(msg.sender)["title"]
+            else:
+                sender = str(msg.sender_id or chat_id)
+            fetched.append({
+                "id": msg.id,
+                "date": int(msg.date.timestamp()),
+                "sender": sender,
+                "text": message_text(msg),
+            })
+        fetched.reverse()
+        return fetched
 
-    async def send(self, phone, chat_id, text):
+    async def backfill(self, phone, chat_id, limit):
+        """Fetch up to limit messages newer than the local store, oldest first.
+
+        One extra message is asked for: if it arrives, more were missed than
+        fit in limit, and the new ones are stored behind a gap.
+        """
+        client = self.clients.get(phone)
+        if not client or limit <= 0:
+            return []
+        store = self.store(phone, chat_id)
+        fetched = await self._fetch_history(client, phone, chat_id, limit + 1, min_id=store.max_id)
+        if self.stores.get((phone, chat_id)) is not store:
+            return []  # The buffer closed meanwhile; a reopened one has its own store
+        gap = len(fetched) > limit
+        fetched = fetched[-limit:]
+        store.extend(fetched, gap)
         if logger:
-            logger.debug(f"Sending message to {chat_id} from {phone}: {text}")
+            logger.debug("Backfilled %s messages for %s:%s%s", len(fetched), phone, chat_id, " after a gap" if gap else "")
+        return fetched
+
+    async def backfill_older(self, phone, chat_id, before_id, limit):
+        """Fetch up to limit messages just older than before_id, oldest first.
+
+        Paging stops at the next stored message below before_id, closing the
+        gap between them when it is reached.
+        """
         client = self.clients.get(phone)
-        if not client:
-            weechat.prnt("", f"Telegram: {phone} not connected")
+        if not client or limit <= 0:
+            return []
+        store = self.store(phone, chat_id)
+        fetched = await self._fetch_history(client, phone, chat_id, limit + 1,
+                                            offset_id=before_id, min_id=store.id_below(before_id))
+        if self.stores.get((phone, chat_id)) is not store:
+            return []
+        gap = len(fetched) > limit
+        fetched = fetched[-limit:]
+        store.insert_older(fetched, before_id, gap)
+        if logger:
+            logger.debug("Fetched %s older messages for %s:%s", len(fetched), phone, chat_id)
+        return fetched
+
+    async def history(self, phone, chat_id, limit):
+        if phone not in self.clients:
+            prnt("", f"Telegram: {phone} not connected")
+            return
+        await self.backfill(phone, chat_id, limit)
+        store = self.store(phone, chat_id)
+        messages = store.tail(limit)
+        if messages and len(messages) < limit:
+            await self.backfill_older(phone, chat_id, messages[0]["id"], limit - len(messages))
+            messages = store.tail(limit)
+        call_main(self.print_history, phone, chat_id, messages, f"--- last {len(messages)} messages ---")
+
+    async def prefetch(self, phone, chat_id, limit):
+        fetched = await self.backfill(phone, chat_id, limit)
+        if fetched:
+            call_main(self.print_history, phone, chat_id, fetched, f"--- {len(fetched)} new messages ---")
+
+    def print_history(self, phone, chat_id, messages, header):
+        """Print stored messages into an open buffer, skipping ones shown live."""
+        key = (phone, chat_id)
+        buf = self.buffers.get(key)
+        if not buf:
+            return
+        live_min = self.live_min.get(key)
+        if live_min is not None:
+            messages = [m for m in messages if m["id"] < live_min]
+        if not messages:
+            return
+        weechat.prnt(buf, header)
+        for m in messages:
+            if m["text"]:
+                self._print_indexed(buf, phone, chat_id, m["id"], m["date"], "telegram_history,notify_none,no_highlight",
+                                    f"{m['sender']}: {m['text']}", m["sender"], m["text"])
+
+    def _print_indexed(self, buf, phone, chat_id, msg_id, date, tags, shown, sender, text):
+        """Print one message tagged with its id and index the lines WeeChat split it into."""
+        weechat.prnt_date_tags(buf, date, f"{tags},{msg_tag(msg_id)}", shown)
+        count = shown.count("\n") + 1
+        self.lines.add(phone, chat_id, msg_id, first_of_last_lines(buf, count), count, sender, text)
+
+    def render_message(self, phone, chat_id, msg_id, sender, text, out=False, highlight=False):
+        key = (phone, chat_id)
+        buf = self.buffer(phone, chat_id)
+        self.live_min.setdefault(key, msg_id)
+        if highlight:
+            sender = f"{weechat.color('chat_highlight')}{sender}{weechat.color('reset')}"
+        # Hotlist is set per batch in flush_hotlist, not per line
+        self._print_indexed(buf, phone, chat_id, msg_id, 0, "notify_none", f"{sender}: {text}", sender, text)
+        self._count_line(key, buf, msg_id, out, highlight)
+
+    def render_block(self, phone, chat_id, items):
+        """Print an album or forwarded burst as one block under a single sender line.
+
+        Each message is its own prnt, so its lines carry its own tag.
+        """
+        key = (phone, chat_id)
+        buf = self.buffer(phone, chat_id)
+        self.live_min.setdefault(key, items[0][0])
+        previous = None
+        for msg_id, sender, text, _, (out, highlight) in items:
+            if highlight:
+                sender = f"{weechat.color('chat_highlight')}{sender}{weechat.color('reset')}"
+            shown = f"{sender}: {text}" if sender != previous else f"  | {text}"
+            previous = sender
+            self._print_indexed(buf, phone, chat_id, msg_id, 0, "notify_none", shown, sender, text)
+            self._count_line(key, buf, msg_id, out, highlight)
+
+    def _count_line(self, key, buf, msg_id, out, highlight):
+        self.last_id[key] = msg_id
+        if out or weechat.buffer_get_integer(buf, "num_displayed") > 0:
+            self.mark_read(key)
+        else:
+            counts = self.unread.setdefault(key, [0, 0])
+            counts[0] += 1
+            if highlight:
+                counts[1] += 1
+            self.hotlist_dirty.add(key)
+
+    def flush_hotlist(self):
+        """Apply hotlist and unread localvars once per chat touched in this batch."""
+        for key in self.hotlist_dirty:
+            buf = self.buffers.get(key)
+            counts = self.unread.get(key)
+            if not buf or not counts or not counts[0]:
+                continue
+            weechat.buffer_set(buf, "localvar_set_telegram_unread", str(counts[0]))
+            weechat.buffer_set(buf, "localvar_set_telegram_mentions", str(counts[1]))
+            weechat.buffer_set(buf, "hotlist", weechat.WEECHAT_HOTLIST_HIGHLIGHT if counts[1]
+                               else weechat.WEECHAT_HOTLIST_MESSAGE)
+        self.hotlist_dirty.clear()
+
+    def mark_read(self, key):
+        """Clear counters and queue a read acknowledgement for the next batch."""
+        self.unread.pop(key, None)
+        buf = self.buffers.get(key)
+        if buf:
+            weechat.buffer_set(buf, "localvar_del_telegram_unread", "")
+            weechat.buffer_set(buf, "localvar_del_telegram_mentions", "")
+        last_id = self.last_id.get(key)
+        if last_id:
+            self.read_pending[key] = last_id
+
+    async def send_read_acks(self, pending):
+        """One read acknowledgement per chat for everything viewed since the last batch."""
+        for (phone, chat_id), max_id in pending.items():
+            client = self.clients.get(phone)
+            if not client:
+                continue
+            try:
+                await client.send_read_acknowledge(int(chat_id), max_id=max_id)
+            except Exception as e:
+                if logger:
+                    logger.warning("Read acknowledge failed for %s:%s: %s", phone, chat_id, e)
+        if logger:
+            logger.debug("Sent %s read acknowledgements", len(pending))
+
+    def render_edit(self, phone, chat_id, msg_id, sender, text):
+        """Rewrite the printed lines of an edited message.
+
+        Edits of messages that are not on screen are dropped: reactions and
+        view counts also arrive as edits, and printing those again would
+        repeat old messages.
+        """
+        entry = self.lines.get(phone, chat_id, msg_id)
+        if entry is None or entry[3] == text:
+            return
+        lines = self._live_lines(phone, chat_id, msg_id, entry)
+        if not lines:
+            return
+        entry[3] = text
+        self._rewrite_lines(lines, f"{sender}: {text} {weechat.color('darkgray')}(edited)")
+
+    def render_delete(self, phone, chat_id, msg_ids):
+        for msg_id in msg_ids:
+            cid = chat_id or self.lines.chat_of(phone, msg_id)
+            entry = self.lines.get(phone, cid, msg_id) if cid else None
+            lines = self._live_lines(phone, cid, msg_id, entry) if entry else []
+            if lines:
+                self._rewrite_lines(lines, f"{entry[2]}: {weechat.color('darkgray')}(deleted) {entry[3]}")
+
+    def _live_lines(self, phone, chat_id, msg_id, entry):
+        """line_data of an index entry, forgetting the entry if WeeChat freed its lines."""
+        buf = self.buffers.get((phone, chat_id))
+        lines = lines_data_if_alive(buf, entry[0], msg_tag(msg_id), entry[1]) if buf else []
+        if not lines:
+            self.lines.discard(phone, chat_id, msg_id)
             if logger:
-                logger.error(f"Phone not connected: {phone}")
+                logger.debug("Lines of %s:%s#%s are gone", phone, chat_id, msg_id)
+        return lines
+
+    def _rewrite_lines(self, lines, message):
+        """Spread message over a message's printed lines, whatever its new line count."""
+        parts = message.split("\n")
+        if len(parts) > len(lines):
+            parts[len(lines) - 1:] = [" ".join(parts[len(lines) - 1:])]
+        parts += [""] * (len(lines) - len(parts))
+        hdata = weechat.hdata_get("line_data")
+        for data, part in zip(lines, parts):
+            weechat.hdata_update(hdata, data, {"message": part})
+
+    def _open_history(self, phone, chat_id):
+        """Show cached history from disk, then fetch what arrived since."""
+        try:
+            limit = int(get_option("history_prefetch"))
+        except ValueError:
+            limit = 0
+        if limit <= 0:
             return
+        cached = self.store(phone, chat_id).tail(limit)
+        if cached:
+            self.print_history(phone, chat_id, cached, "--- history ---")
+        if phone in self.clients:
+            submit(self.prefetch(phone, chat_id, limit), "history", f"{phone}:{chat_id}")
+
+    def _auto_download(self, message):
         try:
-            await client.send_message(int(chat_id), text)
-            if logger:
-                logger.info(f"Message sent to {chat_id} from {phone}")
+            limit = int(get_option("media_auto_download_kb")) * 1024
+        except ValueError:
+            limit = 0
+        return limit > 0 and message.file is not None and (message.file.size or 0) <= limit
+
+    async def download(self, phone, chat_id, message):
+        """Download a message's media into the cache, then print where it is."""
+        client = self.clients.get(phone)
+        if not client:
+            return
+        name = media_key(message)
+        path = self.media.lookup(name)
+        if path is None:
+            try:
+                part_size = min(512, max(4, int(get_option("media_part_size_kb"))))
+            except ValueError:
+                part_size = 512
+            key = (phone, chat_id, message.id)
+            label = f"dl#{message.id}"
+            tmp = self.media.path(f"{name}.part")
+            progress = lambda done, total: self.transfers.progress(key, label, done, total)
+            try:
+                if message.document:
+                    await client.download_file(message.document, tmp, part_size_kb=part_size,
+                                               file_size=message.document.size,
+                                               progress_callback=progress)
+                else:
+                    await client.download_media(message, file=tmp, progress_callback=progress)
+                os.replace(tmp, self.media.path(name))
+                path = self.media.add(name)
+            finally:
+                self.transfers.finish(key)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        if logger:
+            logger.info("Media %s from %s:%s at %s", message.id, phone, chat_id, path)
+        call_main(self._print_media, phone, chat_id, message.id, path)
+
+    async def download_by_id(self, phone, chat_id, msg_id):
+        client = self.clients.get(phone)
+        if not client:
+            prnt("", f"Telegram: {phone} not connected")
+            return
+        message = await client.get_messages(int(chat_id), ids=msg_id)
+        if not message or not (message.photo or message.document):
+            prnt("", f"Telegram: message {msg_id} has no downloadable media")
+            return
+        await self.download(phone, chat_id, message)
+
+    BIG_FILE  = 10 * 1024 * 1024  # Telegram wants SaveBigFilePart above this size
+    MAX_PARTS = 4000  # Telegram's limit on the parts of one file
+
+    async def upload(self, phone, chat_id, path, caption=""):
+        """Stream a file from disk to a chat and send it."""
+        client = self.clients.get(phone)
+        if not client:
+            prnt("", f"Telegram: {phone} not connected")
+            return
+        path = os.path.expanduser(path)
+        if not os.path.isfile(path):
+            prnt("", f"Telegram: no such file {path}")
+            return
+        try:
+            part_kb = min(512, max(1, int(get_option("upload_part_size_kb"))))
         except ValueError:
-            weechat.prnt("", f"Telegram: invalid chat_id {chat_id}")
+            part_kb = 512
+        part_kb = 1 << (part_kb.bit_length() - 1)  # Parts must divide 512 KB
+        try:
+            parallel = max(1, int(get_option("upload_parallel_parts")))
+        except ValueError:
+            parallel = 4
+        size = os.path.getsize(path)
+        key = ("upload", phone, chat_id, path)
+        label = f"up:{os.path.basename(path)}"
+        progress = lambda done, total: self.transfers.progress(key, label, done, total)
+        while part_kb < 512 and size > self.MAX_PARTS * part_kb * 1024:
+            part_kb *= 2
+        if size > self.MAX_PARTS * part_kb * 1024:
+            prnt("", f"Telegram: {path} is too large to upload ({size // (1024 * 1024)} MB)")
+            return
+        started = time.monotonic()
+        try:
+            if size > self.BIG_FILE:
+                input_file = await self._upload_parallel(client, path, size, part_kb * 1024, parallel, progress)
+            else:
+                input_file = await client.upload_file(path, part_size_kb=part_kb, progress_callback=progress)
+            await client.send_file(int(chat_id), input_file, caption=caption)
+        finally:
+            self.transfers.finish(key)
+        elapsed = time.monotonic() - started
+        prnt("", f"Telegram: uploaded {os.path.basename(path)} ({size // 1024} KB) to {chat_id} in {elapsed:.1f}s")
+        if logger:
+            logger.info("Uploaded %s (%s bytes) to %s:%s in %.3fs", path, size, phone, chat_id, elapsed)
+
+    async def _upload_parallel(self, client, path, size, part_size, parallel, progress):
+        """Send the parts of a big file with up to parallel requests in flight.
+
+        Each worker reads its own part with pread, so at most parallel parts
+        are held in memory whatever the file size.
+        """
+        file_id = random.getrandbits(63)
+        part_count = (size + part_size - 1) // part_size
+        parts = iter(range(part_count))  # shared: each index goes to one worker
+        uploaded = 0
+        running = asyncio.get_running_loop()
+        reads = set()  # pread futures still running, all awaited before fd is closed
+        fd = os.open(path, os.O_RDONLY)
+
+        async def worker():
+            nonlocal uploaded
+            for index in parts:
+                read = running.run_in_executor(None, os.pread, fd, part_size, index * part_size)
+                reads.add(read)
+                read.add_done_callback(reads.discard)
+                data = await asyncio.shield(read)  # A cancelled worker leaves the read to finish
+                request = functions.upload.SaveBigFilePartRequest(file_id, index, part_count, data)
+                while True:
+                    try:
+                        ok = await client(request)
+                        break
+                    except FloodWaitError as e:
+                        await asyncio.sleep(e.seconds)
+                if not ok:
+                    raise RuntimeError(f"Failed to upload part {index} of {path}")
+                uploaded += len(data)
+                progress(uploaded, size)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(parallel, part_count))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # gather does not cancel the other workers when one fails
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if reads:
+                await asyncio.wait(list(reads))
+            os.close(fd)
+        return types.InputFileBig(file_id, part_count, os.path.basename(path))
+
+    def _print_media(self, phone, chat_id, msg_id, path):
+        buf = self.buffers.get((phone, chat_id))
+        if buf:
+            weechat.prnt(buf, f"[media #{msg_id}] {path}")
+
+    def send(self, phone, chat_id, text):
+        """Queue text for chat_id; runs on the loop thread, keeps submission order."""
+        if logger:
+            logger.debug("Sending message to %s from %s: %s", chat_id, phone, Redacted(text))
+        queue = self.send_queues.get(phone)
+        if not queue:
+            prnt("", f"Telegram: {phone} not connected")
             if logger:
-                logger.error(f"Invalid chat_id: {chat_id}")
-        except Exception as e:
-            weechat.prnt("", f"Telegram: failed to send message: {e}")
+                logger.error("Phone not connected: %s", phone)
+            return
+        try:
+            int(chat_id)
+        except ValueError:
+            prnt("", f"Telegram: invalid chat_id {chat_id}")
             if logger:
-                logger.exception(f"Send message error: {e}")
+                logger.error("Invalid chat_id: %s", chat_id)
+            return
+        queue.put(chat_id, text)
+
+    async def _on_edit(self, event):
+        await self._on_message(event, "edit")
+
+    async def _on_delete(self, event):
+        phone = getattr(event.client, '_phone', None)
+        if phone:
+            if event.chat_id and not self.filters[phone].admits(event.chat_id):
+                return
+            cid = str(event.chat_id) if event.chat_id else None
+            turn = None
+            try:
+                if cid:
+                    prev, turn = self._take_turn((phone, cid))
+                    if prev:
+                        await prev  # Let messages still resolving their sender reach a group first
+                ids = self._drop_from_groups(phone, cid, event.deleted_ids)
+                if ids:
+                    self.queue.put(("delete", phone, cid, ids, None, None, time.monotonic(), None))
+                    _wakeup()
+            finally:
+                if turn:
+                    self._end_turn((phone, cid), turn)
+
+    async def _on_chat_action(self, event):
+        """Apply joins and leaves to cached member lists and open nicklists."""
+        phone = getattr(event.client, '_phone', None)
+        if not phone:
+            return
+        joined = event.user_joined or event.user_added
+        if not (joined or event.user_left or event.user_kicked):
+            return
+        if not self.filters[phone].admits(event.chat_id):
+            return
+        key = (phone, str(event.chat_id))
+        for user_id in event.user_ids or []:
+            name = None
+            if joined:
+                record = self.cache(phone).get(user_id)
+                if record is None and phone in self.resolvers:
+                    record = await self.resolvers[phone].resolve(user_id)
+                name = (record["title"] or record["username"]) if record else str(user_id)
+            call_main(self._nick_change, key, user_id, name)
+
+    def _nick_change(self, key, user_id, name):
+        old = (self.participants.get(key) or {}).get(user_id)
+        self.participants.update(key, user_id, name)
+        buf = self.buffers.get(key)
+        if not buf or key not in self.nicklists:
+            return
+        if name:
+            if not weechat.nicklist_search_nick(buf, "", name):
+                weechat.nicklist_add_nick(buf, "", name, "", "", "", 1)
+        elif old:
+            nick = weechat.nicklist_search_nick(buf, "", old)
+            if nick:
+                weechat.nicklist_remove_nick(buf, nick)
 
-    async def _on_message(self, event):
+    def rebuild_matchers(self):
+        for phone, me in list(self.me_users.items()):
+            self.matchers[phone] = HighlightMatcher(highlight_keywords(me))
+
+    def ensure_nicklist(self, key):
+        """Fill a group nicklist the first time its buffer is viewed."""
+        if key in self.nicklists or key not in self.buffers:
+            return
+        record = self.cache(key[0]).get(key[1])
+        if not record or record["type"] != "group":
+            return
+        self.nicklists.add(key)
+        members = self.participants.get(key)
+        if members is not None:
+            self._fill_nicklist(key, members)
+        elif key[0] in self.clients:
+            submit(self.fetch_participants(key), "nicklist", f"{key[0]}:{key[1]}")
+
+    async def fetch_participants(self, key):
+        """Page through at most nicklist_max members; never the whole group."""
+        phone, chat_id = key
+        client = self.clients.get(phone)
+        if not client:
+            return
+        try:
+            limit = max(1, int(get_option("nicklist_max")))
+        except ValueError:
+            limit = 500
+        members = {}
+        participants = client.iter_participants(int(chat_id), limit=limit)
+        async for user in participants:
+            members[user.id] = utils.get_display_name(user) or str(user.id)
+        self.participants.put(key, members)
+        if logger:
+            logger.debug("Loaded %s/%s members of %s:%s", len(members), participants.total, phone, chat_id)
+        call_main(self._fill_nicklist, key, members)
+
+    def _fill_nicklist(self, key, members):
+        buf = self.buffers.get(key)
+        if not buf:
+            return
+        weechat.nicklist_remove_all(buf)
+        for name in sorted(set(members.values()), key=str.lower):
+            weechat.nicklist_add_nick(buf, "", name, "", "", "", 1)
+
+    async def _on_message(self, event, kind="message"):
+        received = time.monotonic()
+        turn = None
         try:
             phone = getattr(event.client, '_phone', None)
             if not phone:
                 if logger:
                     logger.error("No phone attribute in client")
                 return
-            chat = event.chat if hasattr(event, 'chat') else None
-            if not chat:
-                if logger:
-                    logger.error("No chat in event")
+            if not self.filters[phone].admits(event.chat_id):
                 return
-            cid = str(chat.id)
-            sender = chat.title or chat.username or cid
-            text = event.message.text or ''
+            key = (phone, str(event.chat_id))
+            prev, turn = self._take_turn(key)
+            cache = self.cache(phone)
+            chat = event.chat  # Only what the update carried, never a network call
+            if chat:
+                record = cache.put(chat)
+            else:
+                record = cache.get(event.chat_id)
+            if not record:
+                chat = await event.get_chat()
+                if not chat:
+                    if logger:
+                        logger.error("No chat in event")
+                    return
+                record = cache.put(chat)
+            cid = str(event.chat_id)
+            sender = await self._sender_name(phone, event, record)
+            text = message_text(event.message)
+            if prev:
+                await prev  # An earlier message of this chat may still be resolving its sender
             if text:
-                self.queue.put((phone, cid, sender, text))
+                highlight = not event.message.out and (
+                    event.message.mentioned or self.matchers[phone].match(text))
+                item = (event.message.id, sender, text, received, (event.message.out, highlight))
+                group = event.message.grouped_id or ("fwd" if event.message.fwd_from else None)
+                if kind == "message" and group and self.coalesce:
+                    self._collect(phone, cid, group, item)
+                else:
+                    self._flush_group(self.open_groups.get((phone, cid)))
+                    self.queue.put((kind, phone, cid) + item)
+                    _wakeup()
                 if logger:
-                    logger.debug(f"Message queued: {phone}, {cid}, {sender}, {text}")
+                    logger.debug("Message queued: %s, %s, %s, %s, %s", kind, phone, cid, sender, Redacted(text))
+            if kind == "message" and (event.message.photo or event.message.document) and self._auto_download(event.message):
+                submit(self.download(phone, cid, event.message), "download", f"{phone}:{cid}#{event.message.id}")
         except Exception as e:
             if logger:
-                logger.exception(f"Error processing message: {e}")
+                logger.exception("Error processing message: %s", e)
+            else:
+                prnt("", f"Telegram: Error processing message: {e}")
+        finally:
+            if turn:
+                self._end_turn(key, turn)
+
+    def _take_turn(self, key):
+        """Reserve the next place in a chat's queue order: (previous turn or None, own turn)."""
+        prev = self.chat_turns.get(key)
+        turn = self.chat_turns[key] = asyncio.get_running_loop().create_future()
+        return prev, turn
+
+    def _end_turn(self, key, turn):
+        turn.set_result(None)
+        if self.chat_turns.get(key) is turn:
+            del self.chat_turns[key]
+
+    def _collect(self, phone, cid, group, item):
+        """Hold album parts / forwarded bursts for the coalescing window."""
+        key = (phone, cid, group)
+        if self.open_groups.get((phone, cid)) not in (None, key):
+            self._flush_group(self.open_groups[(phone, cid)])
+        items = self.groups.setdefault(key, [])
+        items.append(item)
+        if len(items) == 1:
+            self.open_groups[(phone, cid)] = key
+            asyncio.get_running_loop().call_later(self.coalesce, self._flush_group, key)
+
+    def _drop_from_groups(self, phone, cid, msg_ids):
+        """Take deleted messages out of blocks still collecting; returns the ids not found there.
+
+        Deletions without a chat (private chats and small groups) look at
+        every open group of the account.
+        """
+        remaining = set(msg_ids)
+        for key in [k for k in self.groups if k[0] == phone and (cid is None or k[1] == cid)]:
+            items = self.groups[key]
+            kept = [item for item in items if item[0] not in remaining]
+            if len(kept) == len(items):
+                continue
+            remaining -= {item[0] for item in items}
+            if kept:
+                self.groups[key] = kept
             else:
-                weechat.prnt("", f"Telegram: Error processing message: {e}")
+                del self.groups[key]
+                if self.open_groups.get(key[:2]) == key:
+                    del self.open_groups[key[:2]]
+        return [msg_id for msg_id in msg_ids if msg_id in remaining]
+
+    def _flush_group(self, key):
+        """Queue collected items as one block; earlier flushes make this a no-op."""
+        items = self.groups.pop(key, None) if key else None
+        if not items:
+            return
+        phone, cid, _ = key
+        if self.open_groups.get((phone, cid)) == key:
+            del self.open_groups[(phone, cid)]
+        if len(items) == 1:
+            self.queue.put(("message", phone, cid) + items[0])
+        else:
+            self.queue.put(("block", phone, cid, None, None, items, items[0][3], None))
+        _wakeup()
+
+    async def _sender_name(self, phone, event, chat_record):
+        """Display name of the message author, from cache or a batched lookup."""
+        sender_id = event.sender_id
+        if event.out:
+            return self.me.get(phone) or str(sender_id)
+        if event.is_private or sender_id is None or sender_id == event.chat_id:
+            record = chat_record
+        elif event.sender:
+            record = self.cache(phone).put(event.sender)
+        else:
+            record = self.cache(phone).get(sender_id)
+            if record is None and phone in self.resolvers:
+                record = await self.resolvers[phone].resolve(sender_id)
+        if not record:
+            return str(sender_id or event.chat_id)
+        return record["title"] or record["username"] or str(sender_id)
 
     def buffer(self, phone, chat_id):
         key = (phone, chat_id)
         if key not in self.buffers:
             name = f"telegram.{phone}.{chat_id}"
             buf = weechat.buffer_new(name, "buffer_input_cb", "", "buffer_close_cb", "")
-            weechat.buffer_set(buf, "title", f"Telegram {phone}:{chat_id}")
+            record = self.cache(phone).get(chat_id)
+            if record and record["title"]:
+                weechat.buffer_set(buf, "short_name", record["title"])
+                weechat.buffer_set(buf, "title", f"Telegram {phone}: {record['title']}")
+            else:
+                weechat.buffer_set(buf, "title", f"Telegram {phone}:{chat_id}")
+            if record and record["type"] == "group":
+                weechat.buffer_set(buf, "nicklist", "1")
+            weechat.buffer_set(buf, "localvar_set_telegram_phone", phone)
+            weechat.buffer_set(buf, "localvar_set_telegram_chat", chat_id)
             self.buffers[key] = buf
+            self.buffer_keys[buf] = key
             if logger:
-                logger.info(f"Buffer created: {name}")
+                logger.info("Buffer created: %s", name)
+            self._open_history(phone, chat_id)
+            self.hotlist_dirty.add(key)
         return self.buffers[key]
 
+    def forget_buffer(self, buf):
+        """Drop a closed or evicted buffer from both indexes."""
+        key = self.buffer_keys.pop(buf, None)
+        if key is not None:
+            self.buffers.pop(key, None)
+            self.live_min.pop(key, None)
+            with self.create_lock:
+                self.stores.pop(key, None)
+            self.lines.drop_chat(*key)
+            self.hotlist_dirty.discard(key)
+            self.nicklists.discard(key)
+        return key
+
 # --- Callbacks --------------------------------------------------------------
 
-def process_cb(data, remaining):
-    while not manager.queue.empty():
-        phone, cid, sender, msg = manager.queue.get()
-        buf = manager.buffer(phone, cid)
-        weechat.prnt(buf, f"{sender}: {msg}")
+def drain_queue():
+    """Print queued messages for at most drain_budget_ms, then yield to WeeChat."""
+    try:
+        budget = max(int(get_option('drain_budget_ms')), 1) / 1000
+    except ValueError:
+        budget = 0.02
+    deadline = time.monotonic() + budget
+    while True:  # Always print at least one item so the queue drains
+        try:
+            kind, phone, cid, msg_id, sender, msg, received, flags = manager.queue.get_nowait()
+        except Empty:
+            break
+        if kind == "message":
+            manager.render_message(phone, cid, msg_id, sender, msg, *flags)
+        elif kind == "edit":
+            manager.render_edit(phone, cid, msg_id, sender, msg)
+        elif kind == "delete":
+            manager.render_delete(phone, cid, msg_id)
+        elif kind == "block":
+            manager.render_block(phone, cid, msg)
+        manager.stats.record(time.monotonic() - received)
+        if time.monotonic() >= deadline:
+            break
+    manager.flush_hotlist()
+    if not manager.queue.empty():
+        _wakeup()  # Budget spent: continue on the next main loop iteration
+
+def buffer_switch_cb(data, signal, signal_data):
+    key = manager.buffer_keys.get(signal_data)
+    if key:
+        manager.mark_read(key)
+        manager.ensure_nicklist(key)
+    return weechat.WEECHAT_RC_OK
+
+def read_ack_cb(data, remaining):
+    if manager.read_pending:
+        pending, manager.read_pending = manager.read_pending, {}
+        submit(manager.send_read_acks(pending), "read", f"{len(pending)} chats")
+    return weechat.WEECHAT_RC_OK
+
+def option_config_cb(data, option, value):
+    """Mirror a changed plugin option, then apply the ones that need it."""
+    key = option.rsplit(".", 1)[-1]
+    options[key] = value or ""  # None when the option is unset
+    if key == "highlight_words":
+        manager.rebuild_matchers()
+    elif key.startswith("log_"):
+        configure_logging()
     return weechat.WEECHAT_RC_OK
 
-def asyncio_cb(data, remaining):
-    """Run asyncio loop for a short time to process tasks."""
+def status_bar_cb(data, item, window):
+    return manager.status() if manager else ""
+
+def transfers_bar_cb(data, item, window):
+    return manager.transfers.render() if manager else ""
+
+def cache_flush_cb(data, remaining):
+    # The periodic timer passes -1; shutdown passes 0 and disconnect() saves the state
+    if not remaining:
+        for cache in list(manager.caches.values()):
+            cache.save()
+        return weechat.WEECHAT_RC_OK
+    submit(manager.save_caches(), "cache", "save entity caches")
+    if manager.clients:
+        submit(manager.save_update_states(), "connect", "save update state, flush sessions")
+    return weechat.WEECHAT_RC_OK
+
+def wakeup_cb(data, fd):
+    """Drain the wakeup pipe and run calls posted by the loop thread."""
     try:
-        start = time.time()
-        loop.run_until_complete(asyncio.sleep(0.2))  # Process tasks for 200ms
-        if logger:
-            logger.debug(f"Asyncio loop ran for {time.time() - start:.3f} seconds, tasks pending: {len(tasks)}")
-    except Exception as e:
-        if logger:
-            logger.exception(f"Error in asyncio loop: {e}")
-        else:
-            weechat.prnt("", f"Telegram: Error in asyncio loop: {e}")
+        while os.read(wakeup_r, 4096):
+            pass
+    except BlockingIOError:
+        pass
+    while True:
+        try:
+            func, args = main_calls.get_nowait()
+        except Empty:
+            break
+        try:
+            func(*args)
+        except Exception as e:
+            if logger:
+                logger.exception("Error in main thread call: %s", e)
+    drain_queue()
     return weechat.WEECHAT_RC_OK
 
 def cmd_cb(data, buf, args):
-    if logger:
-        logger.debug(f"Command received: {args}")
     parts = args.strip().split(maxsplit=3)
     cmd = parts[0].lower() if parts else ''
     if logger:
-        logger.debug(f"Parsed command: cmd={cmd}, parts={parts}")
+        # Arguments carry codes, passwords and message text
+        logger.debug("Command received: cmd=%s, parts=%s", cmd, parts[:2] + [Redacted(p) for p in parts[2:]])
 
     if cmd == 'add' and len(parts) == 2:
         phone = parts[1]
         if logger:
-            logger.info(f"Executing add for phone: {phone}")
+            logger.info("Executing add for phone: %s", phone)
         try:
-            task = loop.create_task(manager.add(phone))
-            tasks.append(task)
+            submit(manager.add(phone), "auth", phone)
             if logger:
-                logger.debug(f"Task created for add: {phone}, total tasks: {len(tasks)}")
+                logger.debug("Task created for add: %s, total tasks: %s", phone, len(tasks))
             weechat.prnt("", f"Telegram: processing add for {phone}")
         except Exception as e:
             weechat.prnt("", f"Telegram: error processing add: {e}")
             if logger:
-                logger.exception(f"Error in add command: {e}")
+                logger.exception("Error in add command: %s", e)
     elif cmd == 'code' and len(parts) == 3:
         phone, code = parts[1], parts[2]
         if logger:
-            logger.info(f"Executing code for phone: {phone}")
+            logger.info("Executing code for phone: %s", phone)
         try:
-            task = loop.create_task(manager.code(phone, code))
-            tasks.append(task)
+            submit(manager.code(phone, code), "auth", phone)
             if logger:
-                logger.debug(f"Task created for code: {phone}, total tasks: {len(tasks)}")
+                logger.debug("Task created for code: %s, total tasks: %s", phone, len(tasks))
         except Exception as e:
             weechat.prnt("", f"Telegram: error processing code: {e}")
             if logger:
-                logger.exception(f"Error in code command: {e}")
+                logger.exception("Error in code command: %s", e)
     elif cmd == 'password' and len(parts) == 3:
         phone, password = parts[1], parts[2]
         if logger:
-            logger.info(f"Executing password for phone: {phone}")
+            logger.info("Executing password for phone: %s", phone)
         try:
-            task = loop.create_task(manager.password(phone, password))
-            tasks.append(task)
+            submit(manager.password(phone, password), "auth", phone)
             if logger:
-                logger.debug(f"Task created for password: {phone}, total tasks: {len(tasks)}")
+                logger.debug("Task created for password: %s, total tasks: %s", phone, len(tasks))
         except Exception as e:
             weechat.prnt("", f"Telegram: error processing password: {e}")
             if logger:
-                logger.exception(f"Error in password command: {e}")
+                logger.exception("Error in password command: %s", e)
     elif cmd == 'connect' and len(parts) == 2:
         phone = parts[1]
         if logger:
-            logger.info(f"Executing connect for phone: {phone}")
+            logger.info("Executing connect for phone: %s", phone)
         try:
-            task = loop.create_task(manager.connect(phone))
-            tasks.append(task)
+            submit(manager.connect(phone), "connect", phone)
             if logger:
-                logger.debug(f"Task created for connect: {phone}, total tasks: {len(tasks)}")
+                logger.debug("Task created for connect: %s, total tasks: %s", phone, len(tasks))
         except Exception as e:
             weechat.prnt("", f"Telegram: error processing connect: {e}")
             if logger:
-                logger.exception(f"Error in connect command: {e}")
+                logger.exception("Error in connect command: %s", e)
     elif cmd == 'disconnect' and len(parts) == 2:
         phone = parts[1]
         if logger:
-            logger.info(f"Executing disconnect for phone: {phone}")
+            logger.info("Executing disconnect for phone: %s", phone)
         try:
-            task = loop.create_task(manager.disconnect(phone))
-            tasks.append(task)
+            submit(manager.disconnect(phone), "connect", phone)
             if logger:
-                logger.debug(f"Task created for disconnect: {phone}, total tasks: {len(tasks)}")
+                logger.debug("Task created for disconnect: %s, total tasks: %s", phone, len(tasks))
         except Exception as e:
             weechat.prnt("", f"Telegram: error processing disconnect: {e}")
             if logger:
-                logger.exception(f"Error in disconnect command: {e}")
+                logger.exception("Error in disconnect command: %s", e)
     elif cmd == 'list':
         if logger:
             logger.info("Executing list command")
         manager.list()
+    elif cmd == 'history':
+        key = manager.buffer_keys.get(buf)
+        if not key:
+            weechat.prnt(buf, "Telegram: /telegram history must be run in a Telegram chat buffer")
+        else:
+            try:
+                limit = int(parts[1]) if len(parts) > 1 else 50
+            except ValueError:
+                limit = 50
+            submit(manager.history(key[0], key[1], limit), "history", f"{key[0]}:{key[1]}")
+    elif cmd == 'media' and len(parts) == 2 and parts[1].isdigit():
+        key = manager.buffer_keys.get(buf)
+        if not key:
+            weechat.prnt(buf, "Telegram: /telegram media must be run in a Telegram chat buffer")
+        else:
+            submit(manager.download_by_id(key[0], key[1], int(parts[1])), "download", f"{key[0]}:{key[1]}#{parts[1]}")
+    elif cmd == 'filter' and len(parts) >= 2:
+        phone = parts[1]
+        if len(parts) == 2:
+            manager.filter_stats(phone)
+        elif parts[2] in ('muted', 'unmuted'):
+            manager.set_filter(phone, parts[2])
+        elif len(parts) == 4 and parts[2] in ('allow', 'deny', 'unallow', 'undeny'):
+            try:
+                manager.set_filter(phone, parts[2], int(parts[3]))
+            except ValueError:
+                weechat.prnt("", f"Telegram: invalid chat_id {parts[3]}")
+        else:
+            weechat.prnt("", "Usage: /telegram filter <phone> [allow|deny|unallow|undeny <chat> | muted | unmuted]")
+    elif cmd == 'upload' and len(args.split(maxsplit=4)) >= 4:
+        argv = args.split(maxsplit=4)
+        phone, chat_id, path = argv[1], argv[2], argv[3]
+        caption = argv[4] if len(argv) > 4 else ""
+        submit(manager.upload(phone, chat_id, path, caption), "upload", f"{phone}:{chat_id} {os.path.basename(path)}")
+    elif cmd == 'tasks':
+        if len(parts) == 3 and parts[1] == 'cancel' and parts[2].isdigit():
+            tasks.cancel(int(parts[2]))
+        else:
+            tasks.list()
+    elif cmd == 'stats':
+        weechat.prnt("", f"Telegram: delivery {manager.stats.summary()}")
     elif cmd == 'dialogs':
+        argv = args.split()[1:]
+        phone, limit, kind, unread = None, 100, None, False
+        try:
+            while argv:
+                arg = argv.pop(0)
+                if arg == '--limit':
+                    limit = int(argv.pop(0))
+                elif arg == '--type':
+                    kind = argv.pop(0)
+                    if kind not in ('user', 'group', 'channel'):
+                        raise ValueError(kind)
+                elif arg == '--unread':
+                    unread = True
+                else:
+                    phone = arg
+        except (IndexError, ValueError):
+            weechat.prnt("", "Usage: /telegram dialogs [phone] [--limit N] [--type user|group|channel] [--unread]")
+            return weechat.WEECHAT_RC_OK
         if logger:
-            logger.info(f"Executing dialogs command, phone: {parts[1] if len(parts) > 1 else 'all'}")
+            logger.info("Executing dialogs command, phone: %s", phone or 'all')
         try:
-            if len(parts) == 2:
-                task = loop.create_task(manager.dialogs(parts[1]))
-            else:
-                task = loop.create_task(manager.dialogs())
-            tasks.append(task)
+            submit(manager.dialogs(phone, limit, kind, unread), "dialogs", phone or "all")
             if logger:
-                logger.debug(f"Task created for dialogs, total tasks: {len(tasks)}")
+                logger.debug("Task created for dialogs, total tasks: %s", len(tasks))
         except Exception as e:
             weechat.prnt("", f"Telegram: error processing dialogs: {e}")
             if logger:
-                logger.exception(f"Error in dialogs command: {e}")
+                logger.exception("Error in dialogs command: %s", e)
     elif cmd == 'send' and len(parts) >= 4:
         phone, chat_id = parts[1], parts[2]
         text = parts[3]
         if logger:
-            logger.info(f"Executing send for phone: {phone}, chat_id: {chat_id}")
+            logger.info("Executing send for phone: %s, chat_id: %s", phone, chat_id)
         try:
-            task = loop.create_task(manager.send(phone, chat_id, text))
-            tasks.append(task)
-            if logger:
-                logger.debug(f"Task created for send: {phone}, chat_id: {chat_id}, total tasks: {len(tasks)}")
+            loop.call_soon_threadsafe(manager.send, phone, chat_id, text)
         except Exception as e:
             weechat.prnt("", f"Telegram: error processing send: {e}")
             if logger:
-                logger.exception(f"Error in send command: {e}")
+                logger.exception("Error in send command: %s", e)
     else:
-        weechat.prnt(buf, "Usage: /telegram add <phone> | code <phone> <CODE> | password <phone> <PWD> | connect <phone> | disconnect <phone> | list | dialogs [phone] | send <phone> <chat> <msg>")
+        weechat.prnt(buf, "Usage: /telegram add <phone> | code <phone> <CODE> | password <phone> <PWD> | connect <phone> | disconnect <phone> | list | filter <phone> [allow|deny|unallow|undeny <chat> | muted | unmuted] | history [n] | media <msg_id> | tasks [cancel <id>] | stats | dialogs [phone] [--limit N] [--type user|group|channel] [--unread] | send <phone> <chat> <msg> | upload <phone> <chat> <path> [caption]")
         if logger:
             logger.debug("Invalid command syntax")
     return weechat.WEECHAT_RC_OK
 
 def buffer_input_cb(data, buf, inp):
-    for (ph, c), b in manager.buffers.items():
-        if b == buf:
+    key = manager.buffer_keys.get(buf)
+    if key:
+        ph, c = key
+        if logger:
+            logger.debug("Sending message from buffer: %s, %s, %s", ph, c, Redacted(inp))
+        try:
+            loop.call_soon_threadsafe(manager.send, ph, c, inp)
+        except Exception as e:
             if logger:
-                logger.debug(f"Sending message from buffer: {ph}, {c}, {inp}")
-            try:
-                task = loop.create_task(manager.send(ph, c, inp))
-                tasks.append(task)
-                if logger:
-                    logger.debug(f"Task created for buffer input: {ph}, {c}, total tasks: {len(tasks)}")
-            except Exception as e:
-                if logger:
-                    logger.exception(f"Error in buffer input: {e}")
-                else:
-                    weechat.prnt("", f"Telegram: Error in buffer input: {e}")
-            break
+                logger.exception("Error in buffer input: %s", e)
+            else:
+                weechat.prnt("", f"Telegram: Error in buffer input: {e}")
     return weechat.WEECHAT_RC_OK
 
 def buffer_close_cb(data, buf):
-    for key, b in list(manager.buffers.items()):
-        if b == buf:
-            del manager.buffers[key]
-            if logger:
-                logger.info(f"Buffer closed: {key}")
+    key = manager.forget_buffer(buf)
+    if key and logger:
+        logger.info("Buffer closed: %s", key)
     return weechat.WEECHAT_RC_OK
 
 def shutdown_cb():
     if logger:
         logger.info("Shutting down plugin")
     try:
-        for ph in list(manager.clients.keys()):
-            task = loop.create_task(manager.disconnect(ph))
-            tasks.append(task)
-        # Wait for tasks to complete
-        loop.run_until_complete(loop.shutdown_asyncgens())
-        for task in tasks:
-            if not task.done():
-                task.cancel()
-        loop.run_until_complete(loop.shutdown_default_executor())
+        pending = [submit(manager.disconnect(ph), "connect", ph) for ph in list(manager.clients.keys())]
+        for future in pending:
+            try:
+                future.result(timeout=5)
+            except Exception as e:
+                if logger:
+                    logger.exception("Error disconnecting during shutdown: %s", e)
+        tasks.cancel_all()
+        cache_flush_cb("", 0)
+        asyncio.run_coroutine_threadsafe(loop.shutdown_asyncgens(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(timeout=5)
         loop.close()
+        if wakeup_hook:
+            weechat.unhook(wakeup_hook)
+        os.close(wakeup_r)
+        os.close(wakeup_w)
         if logger:
             logger.info("Asyncio loop closed")
     except Exception as e:
         if logger:
-            logger.exception(f"Error during shutdown: {e}")
+            logger.exception("Error during shutdown: %s", e)
         else:
             weechat.prnt("", f"Telegram: Error during shutdown: {e}")
     if logger:
         logger.info("Plugin shutdown complete")
+    if log_listener:
+        log_listener.stop()  # Writes out whatever is still queued
     return weechat.WEECHAT_RC_OK
 
 # --- Initialization --------------------------------------------------------
 
+def _run_loop():
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+    except Exception as e:
+        if logger:
+            logger.exception("Error in asyncio loop: %s", e)
+
 def start_loop():
-    global loop
+    """Run the asyncio loop on its own thread so WeeChat never blocks on it."""
+    global loop, loop_thread, wakeup_r, wakeup_w, tasks
     try:
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
         loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        tasks = TaskManager()
+        loop_thread = threading.Thread(target=_run_loop, name="telegram-loop", daemon=True)
+        loop_thread.start()
         if logger:
-            logger.info("Asyncio loop initialized")
+            logger.info("Asyncio loop thread started")
         else:
             weechat.prnt("", "Telegram: Asyncio loop initialized (logger not available)")
     except Exception as e:
         if logger:
-            logger.exception(f"Error initializing asyncio loop: {e}")
+            logger.exception("Error initializing asyncio loop: %s", e)
         else:
             weechat.prnt("", f"Telegram: Error initializing asyncio loop: {e}")
         raise
@@ -556,26 +2708,42 @@ if __name__ == '__main__':
 
         update_weechat_dir()  # Update directory after registration
         setup_config()
+        configure_logging()
         manager = TelegramAccountManager()
+        weechat.hook_config('plugins.var.python.telegram.*', 'option_config_cb', '')
 
         weechat.hook_command(
             'telegram',
             'Telegram commands',
-            'add <phone> | code <phone> <CODE> | password <phone> <PWD> | connect <phone> | disconnect <phone> | list | dialogs [phone] | send <phone> <chat> <msg>',
+            'add <phone> | code <phone> <CODE> | password <phone> <PWD> | connect <phone> | disconnect <phone> | list | filter <phone> [allow|deny|unallow|undeny <chat> | muted | unmuted] | history [n] | media <msg_id> | tasks [cancel <id>] | stats | dialogs [phone] [--limit N] [--type user|group|channel] [--unread] | send <phone> <chat> <msg> | upload <phone> <chat> <path> [caption]',
             'Manage Telegram accounts and chats',
-            'add|code|password|connect|disconnect|list|dialogs|send',
+            'add|code|password|connect|disconnect|list|filter|history|media|tasks|stats|dialogs|send|upload',
             'cmd_cb', ''
         )
 
-        interval = int(weechat.config_get_plugin('reconnect_interval')) * 1000
-        weechat.hook_timer(interval, 0, 0, 'process_cb', '')
-        weechat.hook_timer(100, 0, 0, 'asyncio_cb', '')  # Run asyncio every 100ms
+        wakeup_hook = weechat.hook_fd(wakeup_r, 1, 0, 0, 'wakeup_cb', '')
+        weechat.hook_timer(60 * 1000, 0, 0, 'cache_flush_cb', '')
+        weechat.bar_item_new('telegram_transfers', 'transfers_bar_cb', '')
+        weechat.bar_item_new('telegram_status', 'status_bar_cb', '')
+        submit(manager.supervise(), "supervisor", "connections")
+        weechat.hook_signal('buffer_switch', 'buffer_switch_cb', '')
+        try:
+            read_ack_interval = max(1, int(get_option('read_ack_interval')))
+        except ValueError:
+            read_ack_interval = 3
+        weechat.hook_timer(read_ack_interval * 1000, 0, 0, 'read_ack_cb', '')
+        if weechat.config_string_to_boolean(get_option('autoconnect')) and manager.accounts:
+            try:
+                parallel = max(1, int(get_option('autoconnect_parallel')))
+            except ValueError:
+                parallel = 4
+            submit(manager.autoconnect(parallel), "connect", "autoconnect")
         weechat.prnt("", f"Telegram plugin v{SCRIPT_VERSION} loaded")
         if logger:
             logger.info("Plugin loaded successfully")
     except Exception as e:
         if logger:
-            logger.exception(f"Error during plugin initialization: {e}")
+            logger.exception("Error during plugin initialization: %s", e)
         else:
             weechat.prnt("", f"Telegram: Error during plugin initialization: {e}")
         raise
@@ -0,0 +1,46 @@
+"""Per-message cost of HighlightMatcher as the keyword list grows.
+
+    python bench/bench_highlight.py
+
+A combined alternation regex is timed alongside for comparison.
+"""
+
+import os
+import random
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stubs  # noqa: E402
+
+stubs.install()
+import telegram_http  # noqa: E402
+
+random.seed(42)
+
+
+def word(n=7):
+    return "".join(random.choice(string.ascii_lowercase) for _ in range(n))
+
+
+def main():
+    vocabulary = [word(random.randint(3, 9)) for _ in range(2000)]
+    messages = [" ".join(random.choice(vocabulary) for _ in range(random.randint(5, 40)))
+                for _ in range(2000)]
+    print(f"{'keywords':>9} {'matcher us/msg':>15} {'regex us/msg':>13}")
+    for count in (10, 100, 1000, 10000):
+        keywords = [word(10) for _ in range(count)]
+        keywords += [f"{word(6)} {word(6)}" for _ in range(count // 10)]
+        matcher = telegram_http.HighlightMatcher(keywords)
+        regex = re.compile(r"\b(?:" + "|".join(map(re.escape, keywords)) + r")\b", re.IGNORECASE)
+        runs = 5
+        t_matcher = timeit.timeit(lambda: [matcher.match(m) for m in messages], number=runs)
+        t_regex = timeit.timeit(lambda: [regex.search(m) for m in messages], number=runs)
+        per = runs * len(messages)
+        print(f"{count:>9} {t_matcher / per * 1e6:>15.2f} {t_regex / per * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Sync replay benchmark of matrix_http against the local fake homeserver.
+
+    PYTHONPATH=/path/to/aiohttp python bench/bench_matrix.py --rooms 50 --events 20 --batches 40 --rate 4
+    PYTHONPATH=/path/to/aiohttp python bench/bench_matrix.py --replay syncs.jsonl --json before.json
+
+The plugin is imported against the stub weechat module and logs in to a
+FakeHomeserver on a random local port. The main thread plays WeeChat by
+running the timers the plugin registered with hook_timer. Reported:
+
+  sync parse     time to decode each /sync body once it has been read
+  events/s       printed messages per second, first served batch to last line
+  queue latency  /sync body decoded -> weechat.prnt of each of its messages
+  delivery       /sync response written by the server -> weechat.prnt
+  main thread    time spent inside each timer callback
+  rss            peak resident memory of the whole process
+
+Real aiohttp is required (the server and the plugin both use it).
+"""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stubs  # noqa: E402
+from fake_homeserver import FakeHomeserver  # noqa: E402
+from report import add_arguments, finish, params, peak_rss_kib, rss_kib, summary_ms  # noqa: E402
+
+MARK = re.compile(r"~(\d+)\.(\d+)~")
+
+
+class SyncProbe:
+    """Timestamps of /sync decoding and of each marked line reaching prnt."""
+
+    def __init__(self, server):
+        self.server  = server
+        self.parse   = []  # seconds per /sync body decode
+        self.sizes   = []  # bytes per /sync body
+        self.decoded = {}  # batch -> monotonic time its body was decoded
+        self.queue   = []  # decoded -> prnt, per message
+        self.deliver = []  # served -> prnt, per message
+        self.printed = 0
+        self.first   = None
+        self.last    = None
+
+    def instrument(self):
+        """Wrap ClientResponse.json to time /sync decoding apart from the network read."""
+        original = aiohttp.ClientResponse.json
+        probe = self
+
+        async def timed_json(response, *args, **kwargs):
+            if not response.url.path.endswith("/sync"):
+                return await original(response, *args, **kwargs)
+            body = await response.read()
+            start = time.perf_counter()
+            data = await original(response, *args, **kwargs)
+            probe.parse.append(time.perf_counter() - start)
+            probe.sizes.append(len(body))
+            token = data.get("next_batch", "")
+            if data.get("rooms", {}).get("join") and token[1:].isdigit():
+                probe.decoded[int(token[1:]) - 1] = time.monotonic()
+            return data
+
+        aiohttp.ClientResponse.json = timed_json
+
+    def on_prnt(self, buf, msg):
+        now = time.monotonic()
+        for batch, _ in MARK.findall(msg):
+            batch = int(batch)
+            self.printed += 1
+            self.first = self.first or self.server.served.get(batch, now)
+            self.last = now
+            if batch in self.decoded:
+                self.queue.append(now - self.decoded[batch])
+            if batch in self.server.served:
+                self.deliver.append(now - self.server.served[batch])
+
+
+def run(args):
+    home = tempfile.mkdtemp(prefix="mx-bench-")
+    weechat = stubs.install(telethon=False)
+    weechat.info["weechat_dir"] = home
+
+    if args.replay:
+        server = FakeHomeserver.replay(args.replay, rate=args.rate)
+    else:
+        server = FakeHomeserver.synthetic(args.batches, args.rooms, args.events, rate=args.rate)
+    expected = sum(server.messages)
+    url = server.start_thread()
+    weechat.config.update({"homeserver": url, "username": "@bench:localhost", "password": "bench"})
+
+    probe = SyncProbe(server)
+    probe.instrument()
+    weechat.on_prnt = probe.on_prnt
+    rss_start = rss_kib()
+    import matrix_http as mx  # registers hooks and starts its loop thread at import
+
+    mx.cmd_matrix("", "", "connect")
+    timers = [[time.monotonic() + interval / 1000, interval / 1000, getattr(mx, callback), data]
+              for interval, callback, data in weechat.timers]
+    blocked = []
+    deadline = time.monotonic() + args.timeout
+    while probe.printed < expected and time.monotonic() < deadline:
+        timer = min(timers, key=lambda t: t[0])
+        delay = timer[0] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        start = time.perf_counter()
+        timer[2](timer[3], 0)
+        blocked.append(time.perf_counter() - start)
+        timer[0] += timer[1]
+
+    mx.M.disconnect()
+    mx.shutdown_cb()  # flushes the queued log records
+    server.stop_thread()
+    log = os.path.join(home, "matrix", "matrix.log")
+    span = (probe.last - probe.first) if probe.printed > 1 else 0
+    return {
+        "version": mx.SCRIPT_VERSION,
+        "params": params(args),
+        "messages": expected,
+        "printed": probe.printed,
+        "events_per_s": round(probe.printed / span, 1) if span else 0,
+        "sync": dict(summary_ms(probe.parse, 50, 95), batches=len(probe.parse),
+                     kib_mean=round(sum(probe.sizes) / max(1, len(probe.sizes)) / 1024, 1)),
+        "queue_latency_ms": summary_ms(probe.queue, 50, 95, 99),
+        "delivery_ms": summary_ms(probe.deliver, 50, 95, 99),
+        "main_thread_ms": dict(summary_ms(blocked, 50, 99), calls=len(blocked)),
+        "rss_kib": {"start": rss_start, "peak": peak_rss_kib()},
+        "log_kib": os.path.getsize(log) // 1024 if os.path.exists(log) else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--events", type=int, default=20, help="timeline events per room per batch")
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=4, help="/sync batches per second (0 = unthrottled)")
+    parser.add_argument("--replay", help="file with one recorded /sync response body per line")
+    parser.add_argument("--timeout", type=float, default=60, help="give up waiting for lines after this many seconds")
+    add_arguments(parser)
+    args = parser.parse_args()
+    finish(args, run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Connect time and write volume: Telethon's SQLiteSession vs BatchedSQLiteSession.
+
+    python bench/bench_session.py [--updates N] [--entities N]
+
+Needs the real telethon package. Each run opens a fresh session file, then
+replays what a busy account does to it: entity batches from updates,
+update-state writes and save() after each. Reopening the file stands in
+for the session part of connect(). Write volume is read from
+/proc/self/io, so it is only reported on Linux.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stubs  # noqa: E402
+
+stubs.install(telethon=False)
+from datetime import datetime, timezone  # noqa: E402
+
+from telethon.sessions import SQLiteSession  # noqa: E402
+from telethon.tl import types  # noqa: E402
+
+import telegram_http  # noqa: E402
+
+
+def write_bytes():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def workload(session, updates, entities):
+    now = datetime.now(timezone.utc)
+    for i in range(updates):
+        users = [types.User(id=1000 + (i * entities + j) % 50000, access_hash=j, first_name=f"u{j}")
+                 for j in range(entities)]
+        session.process_entities(users)
+        session.set_update_state(0, types.updates.State(pts=i, qts=0, date=now, seq=i, unread_count=0))
+        session.save()
+
+
+def run(name, factory, updates, entities):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.session")
+        before = write_bytes()
+        start = time.perf_counter()
+        session = factory(path)
+        workload(session, updates, entities)
+        session.close()
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        factory(path).close()
+        connect = time.perf_counter() - start
+        after = write_bytes()
+    written = f"{(after - before) / 1024:.0f} KiB" if before is not None else "n/a"
+    print(f"{name:<10} workload {elapsed * 1000:8.1f} ms  reopen {connect * 1000:6.2f} ms  written {written}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--entities", type=int, default=5)
+    args = parser.parse_args()
+    run("default", SQLiteSession, args.updates, args.entities)
+    run("batched", lambda path: telegram_http.BatchedSQLiteSession(path, 5), args.updates, args.entities)
+
+
+if __name__ == "__main__":
+    main()
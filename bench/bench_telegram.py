@@ -0,0 +1,245 @@
+"""Load test of telegram_http with a fake TelegramClient, no network or WeeChat.
+
+    python bench/bench_telegram.py --accounts 4 --chats 50 --rate 200 --seconds 10
+    python bench/bench_telegram.py --json after.json --compare before.json
+
+Each account connects through the real TelegramAccountManager.connect path
+with a client that fires NewMessage events at --rate per second, spread over
+--chats chats (half private, half groups). The main thread plays WeeChat: it
+waits on the wakeup pipe and calls wakeup_cb, which is where queued messages
+are printed. Reported:
+
+  latency     event handed to the plugin -> weechat.prnt of its line
+  main thread time spent inside each wakeup_cb call (what WeeChat would block on)
+  queue       depth of manager.queue sampled on every main loop iteration
+  tasks       size of the TaskManager registry (grows with --media downloads)
+  rss         resident memory at start, peak and end of the run
+  log         size of telegram.log written at --log-level
+
+--json writes the report so a later run can be compared with --compare.
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import select
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import stubs  # noqa: E402
+from report import add_arguments, finish, params, rss_kib, summary_ms  # noqa: E402
+
+weechat = stubs.install()
+import telegram_http as tg  # noqa: E402
+
+MARK = re.compile(r"~(\d+)~")
+
+
+class Probe:
+    """Send and print timestamps of every benchmark message, by marker."""
+
+    def __init__(self):
+        self.sent = {}  # marker -> monotonic time the event reached the plugin
+        self.latency = []
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def stamp(self):
+        with self.lock:
+            self.next += 1
+            marker = self.next
+            self.sent[marker] = time.monotonic()
+        return marker
+
+    def on_prnt(self, buf, msg):
+        now = time.monotonic()
+        for marker in MARK.findall(msg):
+            with self.lock:
+                sent = self.sent.pop(int(marker), None)
+            if sent is not None:
+                self.latency.append(now - sent)
+
+
+def entity(cls, entity_id, **attrs):
+    obj = cls()
+    obj.id = entity_id
+    obj.__dict__.update(attrs)
+    return obj
+
+
+class FakeTelegramClient:
+    """The parts of TelegramClient that connect() and the message path use."""
+
+    def __init__(self, session, api_id, api_hash):
+        self.session = session
+        self.handlers = []
+        self.connected = False
+
+    async def connect(self):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_me(self):
+        return entity(tg.User, 1, first_name="Bench", last_name=None, username="bench")
+
+    def add_event_handler(self, callback, event):
+        self.handlers.append((callback, type(event).__name__))
+
+    async def download_media(self, message, file=None, progress_callback=None):
+        await asyncio.sleep(0.01)
+        with open(file, "wb") as f:
+            f.write(b"\0" * message.file.size)
+        if progress_callback:
+            progress_callback(message.file.size, message.file.size)
+        return file
+
+    async def fire(self, probe, chats, rate, seconds, media_every):
+        """Deliver NewMessage events to the plugin on a fixed schedule."""
+        on_message = next(cb for cb, kind in self.handlers if kind == "NewMessage")
+        count = int(rate * seconds)
+        start = time.monotonic()
+        for n in range(count):
+            chat, sender = chats[n % len(chats)]
+            chat.last_id += 1
+            marker = probe.stamp()
+            media = media_every and n % media_every == 0
+            message = SimpleNamespace(
+                id=chat.last_id, text=f"message {n} ~{marker}~", out=False, mentioned=False,
+                grouped_id=None, fwd_from=None, media=media or None, voice=None, sticker=None,
+                document=None, photo=SimpleNamespace(id=marker) if media else None,
+                file=SimpleNamespace(size=2048, ext=".jpg", name=None, mime_type="image/jpeg") if media else None)
+            private = sender is None
+            event = SimpleNamespace(
+                client=self, chat_id=chat.peer_id_marked, chat=chat, message=message, out=False,
+                is_private=private, sender_id=chat.id if private else sender.id, sender=sender)
+            await on_message(event)
+            delay = start + (n + 1) / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+def make_chats(account, count):
+    chats = []
+    for i in range(count):
+        base = account * 100000 + i + 10
+        if i % 2:
+            group = entity(tg.Channel, base, peer_id_marked=-1000000000000 - base, title=f"group {i}",
+                           broadcast=False, username=None, access_hash=base)
+            sender = entity(tg.User, base + 50000, first_name=f"member{i}", last_name=None,
+                            username=None, access_hash=base)
+            chats.append((group, sender))
+            group.last_id = 0
+        else:
+            user = entity(tg.User, base, peer_id_marked=base, first_name=f"user{i}", last_name=None,
+                          username=None, access_hash=base)
+            user.last_id = 0
+            chats.append((user, None))
+    return chats
+
+
+def run(args):
+    home = tempfile.mkdtemp(prefix="tg-bench-")
+    weechat.info["weechat_dir"] = os.path.join(home, ".weechat")
+    tg.CACHE_DIR = os.path.join(home, ".weechat", "telegram", "cache")
+    os.environ["HOME"] = home  # setup_logging writes under ~/.weechat
+    tg.setup_logging()
+    os.makedirs(tg.CACHE_DIR)
+    tg.setup_config()
+    weechat.config.update({"api_id": "1", "api_hash": "bench", "highlight_words": args.highlight_words,
+                           "media_auto_download_kb": "1024" if args.media else "0", "log_level": args.log_level})
+    tg.options.update(weechat.config)  # what option_config_cb would do after a /set
+    tg.configure_logging()
+    tg.TelegramClient = FakeTelegramClient
+    tg.open_session = lambda path: SimpleNamespace(flush=lambda: None)
+    tg.start_loop()
+    tg.manager = manager = tg.TelegramAccountManager()
+
+    probe = Probe()
+    weechat.on_prnt = probe.on_prnt
+    phones = [f"+1555{i:07d}" for i in range(args.accounts)]
+    for phone in phones:
+        manager.accounts[phone] = {"session": phone}
+        manager.cache(phone).mark_refreshed()  # skip the dialog download
+        asyncio.run_coroutine_threadsafe(manager.connect(phone), tg.loop).result(10)
+
+    rss_start = rss_kib()
+    media_every = round(1 / args.media) if args.media else 0
+    firing = [asyncio.run_coroutine_threadsafe(
+        manager.clients[phone].fire(probe, make_chats(i, args.chats), args.rate, args.seconds, media_every),
+        tg.loop) for i, phone in enumerate(phones)]
+
+    blocked, depth, task_counts = [], [], []
+    rss_peak = rss_start
+    started = time.monotonic()
+    deadline = started + args.seconds + args.drain_timeout
+    while time.monotonic() < deadline:
+        ready, _, _ = select.select([tg.wakeup_r], [], [], 0.05)
+        if ready:
+            t0 = time.perf_counter()
+            tg.wakeup_cb("", tg.wakeup_r)
+            blocked.append(time.perf_counter() - t0)
+        depth.append(manager.queue.qsize())
+        task_counts.append(len(tg.tasks))
+        rss_peak = max(rss_peak, rss_kib())
+        if all(f.done() for f in firing) and not probe.sent and not len(tg.tasks):
+            break
+    wall = time.monotonic() - started
+    tasks_end = len(tg.tasks)
+    for f in firing:
+        f.result(0)
+    tg.tasks.cancel_all()  # downloads still queued behind max_downloads
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1), tg.loop).result(5)
+    tg.loop.call_soon_threadsafe(tg.loop.stop)
+    tg.log_listener.stop()
+    log = os.path.join(tg.CONFIG_DIR, "telegram.log")
+    log_kib = os.path.getsize(log) // 1024 if os.path.exists(log) else 0
+    shutil.rmtree(home, ignore_errors=True)
+
+    sent = int(args.rate * args.seconds) * args.accounts
+    return {
+        "version": tg.SCRIPT_VERSION,
+        "params": params(args),
+        "events": sent,
+        "rendered": len(probe.latency),
+        "lost": len(probe.sent),
+        "events_per_s": round(len(probe.latency) / wall, 1),
+        "latency_ms": summary_ms(probe.latency, 50, 95, 99),
+        "main_thread_ms": dict(summary_ms(blocked, 50, 99), calls=len(blocked),
+                               busy_pct=round(100 * sum(blocked) / wall, 2)),
+        "queue_depth": {"max": max(depth, default=0), "mean": round(sum(depth) / max(1, len(depth)), 1)},
+        "tasks": {"peak": max(task_counts, default=0), "end": tasks_end},
+        "rss_kib": {"start": rss_start, "peak": rss_peak, "end": rss_kib()},
+        "log_kib": log_kib,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--chats", type=int, default=20, help="chats per account")
+    parser.add_argument("--rate", type=float, default=100, help="events per second per account")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--media", type=float, default=0, help="fraction of messages with a photo to auto-download")
+    parser.add_argument("--highlight-words", default="deploy,outage,oncall")
+    parser.add_argument("--log-level", default="info", help="log_level option of the plugin")
+    parser.add_argument("--drain-timeout", type=float, default=10, help="seconds to wait for the backlog after firing")
+    add_arguments(parser)
+    args = parser.parse_args()
+    finish(args, run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Minimal Matrix homeserver that replays /sync payloads, for offline benchmarks.
+
+    PYTHONPATH=/path/to/aiohttp python bench/fake_homeserver.py --port 8008 --rooms 20 --events 50
+
+Serves login, sync, send, join, messages and media download/upload under
+the v3 client API. /sync hands out one prepared batch per call, released at
+--rate batches per second; once the batches run out it long-polls like a
+quiet server. Batches are either synthetic (--rooms x --events messages
+each) or replayed from a file with one /sync response body per line
+(--replay). Every m.room.message body gets a " ~batch.n~" marker so a
+client-side probe can match printed lines to the batch that carried them.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+
+from aiohttp import web
+
+MARKER = " ~{batch}.{n}~"
+
+
+def synthetic_batch(batch, rooms, events):
+    """A /sync body with `events` timeline events in each of `rooms` rooms."""
+    now = int(time.time() * 1000)
+    join = {}
+    for r in range(rooms):
+        timeline = []
+        for e in range(events):
+            sender = f"@user{(r + e) % 97}:localhost"
+            if e % 10 == 9:
+                event = {"type": "m.reaction", "content": {"m.relates_to": {
+                    "rel_type": "m.annotation", "event_id": f"$r{r}e{e - 1}b{batch}", "key": "+1"}}}
+            else:
+                event = {"type": "m.room.message", "content": {
+                    "msgtype": "m.text", "body": f"message {e} in room {r} " + "lorem ipsum " * random.randint(0, 8)}}
+            event.update({"sender": sender, "event_id": f"$r{r}e{e}b{batch}", "origin_server_ts": now,
+                          "unsigned": {"age": random.randint(0, 500)}})
+            timeline.append(event)
+        join[f"!room{r}:localhost"] = {
+            "timeline": {"events": timeline, "limited": False, "prev_batch": f"p{batch}"},
+            "state": {"events": []},
+            "ephemeral": {"events": [{"type": "m.typing", "content": {"user_ids": [f"@user{r % 97}:localhost"]}}]},
+            "account_data": {"events": []},
+            "unread_notifications": {"highlight_count": 0, "notification_count": events},
+        }
+    return {"next_batch": f"s{batch + 1}", "rooms": {"join": join, "invite": {}, "leave": {}},
+            "presence": {"events": []}, "account_data": {"events": []}, "device_one_time_keys_count": {}}
+
+
+def mark(body, batch):
+    """Tag message bodies with their batch and position; returns how many were tagged."""
+    count = 0
+    for room in body.get("rooms", {}).get("join", {}).values():
+        for event in room.get("timeline", {}).get("events", []):
+            if event.get("type") == "m.room.message" and "body" in event.get("content", {}):
+                event["content"]["body"] += MARKER.format(batch=batch, n=count)
+                count += 1
+    body["next_batch"] = f"s{batch + 1}"
+    return count
+
+
+class FakeHomeserver:
+    """aiohttp app that serves prepared /sync batches and records what clients send."""
+
+    def __init__(self, batches, rate=0, media_kb=64):
+        self.batches  = batches  # list of /sync bodies, already marked
+        self.messages = [mark(body, i) for i, body in enumerate(batches)]
+        self.rate     = rate     # batches per second, 0 = as fast as the client asks
+        self.media    = bytes(media_kb * 1024)
+        self.sent     = []       # (room_id, event_type, content) from PUT send
+        self.joined   = set()
+        self.served   = {}       # batch index -> monotonic time its /sync response was written
+        self.start    = None
+        self.runner   = None
+        self.url      = None
+        self.loop     = None
+
+    @classmethod
+    def synthetic(cls, count, rooms, events, **kwargs):
+        return cls([synthetic_batch(i, rooms, events) for i in range(count)], **kwargs)
+
+    @classmethod
+    def replay(cls, path, **kwargs):
+        with open(path) as f:
+            return cls([json.loads(line) for line in f if line.strip()], **kwargs)
+
+    def app(self):
+        app = web.Application()
+        v3 = "/_matrix/client/v3"
+        app.router.add_post(f"{v3}/login", self.login)
+        app.router.add_get(f"{v3}/sync", self.sync)
+        app.router.add_put(f"{v3}/rooms/{{room}}/send/{{type}}/{{txn}}", self.send)
+        app.router.add_post(f"{v3}/rooms/{{room}}/join", self.join)
+        app.router.add_post(f"{v3}/join/{{room}}", self.join)
+        app.router.add_get(f"{v3}/rooms/{{room}}/messages", self.room_messages)
+        app.router.add_get("/_matrix/media/v3/download/{server}/{media}", self.download)
+        app.router.add_get("/_matrix/client/v1/media/download/{server}/{media}", self.download)
+        app.router.add_post("/_matrix/media/v3/upload", self.upload)
+        return app
+
+    async def login(self, request):
+        body = await request.json()
+        user = body.get("user") or body.get("identifier", {}).get("user", "@bench:localhost")
+        return web.json_response({"access_token": uuid.uuid4().hex, "user_id": user, "device_id": "BENCH"})
+
+    async def sync(self, request):
+        since = request.query.get("since", "s0")
+        batch = int(since[1:]) if since[1:].isdigit() else 0
+        if batch >= len(self.batches):
+            timeout = min(int(request.query.get("timeout", 0)), 30000) / 1000
+            await asyncio.sleep(timeout)
+            return web.json_response({"next_batch": since, "rooms": {"join": {}}})
+        if self.start is None:
+            self.start = time.monotonic()
+        if self.rate:
+            delay = self.start + batch / self.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        body = json.dumps(self.batches[batch])
+        self.served[batch] = time.monotonic()
+        return web.Response(text=body, content_type="application/json")
+
+    async def send(self, request):
+        self.sent.append((request.match_info["room"], request.match_info["type"], await request.json()))
+        return web.json_response({"event_id": f"${uuid.uuid4().hex}"})
+
+    async def join(self, request):
+        room = request.match_info["room"]
+        self.joined.add(room)
+        return web.json_response({"room_id": room})
+
+    async def room_messages(self, request):
+        limit = min(int(request.query.get("limit", 10)), 1000)
+        start = request.query.get("from", "t0")
+        offset = int(start[1:]) if start[1:].isdigit() else 0
+        room = request.match_info["room"]
+        chunk = [{"type": "m.room.message", "sender": "@user1:localhost", "room_id": room,
+                  "event_id": f"$h{offset + i}", "origin_server_ts": 0,
+                  "content": {"msgtype": "m.text", "body": f"history {offset + i}"}} for i in range(limit)]
+        return web.json_response({"chunk": chunk, "start": start, "end": f"t{offset + limit}"})
+
+    async def download(self, request):
+        return web.Response(body=self.media, content_type="application/octet-stream")
+
+    async def upload(self, request):
+        await request.read()
+        return web.json_response({"content_uri": f"mxc://localhost/{uuid.uuid4().hex}"})
+
+    async def start_server(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app(), access_log=None, shutdown_timeout=1)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    def start_thread(self):
+        """Serve from a private event loop thread; returns the base URL."""
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name="fake-homeserver", daemon=True).start()
+        self.loop = loop
+        return asyncio.run_coroutine_threadsafe(self.start_server(), loop).result(10)
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--events", type=int, default=20, help="timeline events per room per batch")
+    parser.add_argument("--batches", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1, help="batches per second (0 = unthrottled)")
+    parser.add_argument("--replay", help="file with one /sync response body per line")
+    args = parser.parse_args()
+
+    if args.replay:
+        server = FakeHomeserver.replay(args.replay, rate=args.rate)
+    else:
+        server = FakeHomeserver.synthetic(args.batches, args.rooms, args.events, rate=args.rate)
+
+    async def serve():
+        url = await server.start_server(port=args.port)
+        print(f"fake homeserver on {url}: {len(server.batches)} batches, {sum(server.messages)} messages")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Report helpers shared by the load benchmarks: percentiles, RSS, --json/--compare."""
+
+import json
+import resource
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def summary_ms(values, *pcts):
+    """{"p50": ..., "max": ...} in milliseconds for the given percentiles."""
+    out = {f"p{p}": ms(percentile(values, p)) for p in pcts}
+    out["max"] = ms(max(values, default=0))
+    return out
+
+
+def rss_kib():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def flatten(report, prefix=""):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            if key != "params":
+                yield from flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def print_report(report, baseline=None):
+    before = dict(flatten(baseline)) if baseline else {}
+    print(f"{'metric':<24} {'value':>12}" + (f" {'baseline':>12} {'change':>8}" if baseline else ""))
+    for key, value in flatten(report):
+        line = f"{key:<24} {value!s:>12}"
+        old = before.get(key)
+        if baseline and old is not None:
+            line += f" {old!s:>12}"
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                line += f" {100 * (value - old) / old:>+7.1f}%"
+        print(line)
+
+
+def add_arguments(parser):
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--compare", help="baseline report written by an earlier --json run")
+
+
+def finish(args, report):
+    """Print the report, against --compare if given, and save it to --json."""
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def params(args):
+    return {k: v for k, v in vars(args).items() if k not in ("json", "compare")}
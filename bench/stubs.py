@@ -0,0 +1,162 @@
+"""Stand-ins for the weechat and telethon modules so the plugins import offline.
+
+Only what the scripts touch at import time and in the benchmarked paths is
+provided. Call install() before importing telegram_http or matrix_http.
+"""
+
+import sys
+import types
+
+
+def _module(name, **attrs):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attrs)
+    sys.modules[name] = mod
+    return mod
+
+
+class FakeWeechat(types.ModuleType):
+    """weechat module that records prnt calls and answers config lookups."""
+
+    WEECHAT_RC_OK = 0
+    WEECHAT_RC_ERROR = -1
+    WEECHAT_HOTLIST_LOW = "0"
+    WEECHAT_HOTLIST_MESSAGE = "1"
+    WEECHAT_HOTLIST_PRIVATE = "2"
+    WEECHAT_HOTLIST_HIGHLIGHT = "3"
+
+    def __init__(self):
+        super().__init__("weechat")
+        self.config = {}
+        self.printed = []  # (buffer, message)
+        self.on_prnt = None  # optional callable(buffer, message)
+        self.buffers = {}
+        self.localvars = {}
+        self.info = {}  # info_get answers, e.g. weechat_dir
+        self.timers = []  # (interval_ms, callback name, data) from hook_timer
+
+    def _record(self, buf, msg):
+        self.printed.append((buf, msg))
+        if self.on_prnt:
+            self.on_prnt(buf, msg)
+
+    def prnt(self, buf, msg):
+        self._record(buf, msg)
+
+    def prnt_date_tags(self, buf, date, tags, msg):
+        self._record(buf, msg)
+
+    def config_get_plugin(self, key):
+        return self.config.get(key, "")
+
+    def config_set_plugin(self, key, value):
+        self.config[key] = value
+
+    def config_is_set_plugin(self, key):
+        return key in self.config
+
+    def config_set_desc_plugin(self, key, desc):
+        pass
+
+    def config_get(self, name):
+        return name
+
+    def config_integer(self, option):
+        return 4096
+
+    def config_string_to_boolean(self, value):
+        return 1 if value in ("on", "yes", "y", "true", "t", "1") else 0
+
+    def info_get(self, name, args):
+        return self.info.get(name, "")
+
+    def register(self, *args):
+        return True
+
+    def buffer_new(self, name, *callbacks):
+        buf = f"0x{len(self.buffers) + 1:x}"
+        self.buffers[buf] = name
+        return buf
+
+    def buffer_search(self, plugin, name):
+        for buf, buf_name in self.buffers.items():
+            if buf_name == name:
+                return buf
+        return ""
+
+    def buffer_set(self, buf, prop, value):
+        pass
+
+    def buffer_get_integer(self, buf, prop):
+        return 0
+
+    def hook_timer(self, interval, align, max_calls, callback, data):
+        self.timers.append((interval, callback, data))
+        return f"timer{len(self.timers)}"
+
+    def color(self, name):
+        return ""
+
+    def hdata_get(self, name):
+        return name
+
+    def hdata_pointer(self, hdata, ptr, name):
+        return f"{ptr}/{name}"
+
+    def hdata_update(self, hdata, ptr, values):
+        return 1
+
+    def __getattr__(self, name):
+        # hook_*, unhook, bar_item_*, nicklist_* and the like: accept and ignore
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: ""
+
+
+class _Placeholder:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class FloodWaitError(Exception):
+    def __init__(self, seconds=0):
+        super().__init__(f"A wait of {seconds} seconds is required")
+        self.seconds = seconds
+
+
+def _get_display_name(entity):
+    first = getattr(entity, "first_name", None)
+    if first is not None:
+        return " ".join(p for p in (first, getattr(entity, "last_name", None)) if p)
+    return getattr(entity, "title", "") or ""
+
+
+def _get_peer_id(entity):
+    return getattr(entity, "peer_id_marked", getattr(entity, "id", 0))
+
+
+def install(weechat=None, telethon=True):
+    """Register the stand-ins in sys.modules and return the weechat one.
+
+    With telethon=False only weechat is replaced, for benchmarks that need
+    the real Telethon package.
+    """
+    weechat = weechat or FakeWeechat()
+    sys.modules["weechat"] = weechat
+    if not telethon:
+        return weechat
+    utils = _module("telethon.utils", get_display_name=_get_display_name, get_peer_id=_get_peer_id)
+    errors = _module("telethon.errors", SessionPasswordNeededError=type("SessionPasswordNeededError", (Exception,), {}),
+                     FloodWaitError=FloodWaitError)
+    events = _module("telethon.events", **{name: type(name, (_Placeholder,), {}) for name in
+                                           ("NewMessage", "MessageEdited", "MessageDeleted", "ChatAction")})
+    tl_types = _module("telethon.tl.types", User=type("User", (), {}), Channel=type("Channel", (), {}),
+                       Message=type("Message", (), {}))
+    tl_types.updates = _module("telethon.tl.types.updates")
+    sessions = _module("telethon.sessions", SQLiteSession=_Placeholder)
+    functions = _module("telethon.tl.functions")
+    functions.updates = _module("telethon.tl.functions.updates")
+    tl = _module("telethon.tl", functions=functions, types=tl_types)
+    _module("telethon", TelegramClient=_Placeholder, utils=utils, errors=errors, events=events,
+            sessions=sessions, tl=tl)
+    return weechat
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+#
+# daemon_bridge.py — Thin WeeChat side of protocol_daemon.py
+#
+# Instead of loading telegram_http.py or matrix_http.py into WeeChat, load
+# this script: it starts (or reattaches to) one protocol_daemon.py process per
+# configured script and carries out the UI calls those daemons send over
+# their Unix sockets. Commands, buffer input, signals and option changes are
+# forwarded back. Closing WeeChat leaves the daemons connected; the next
+# start reattaches and the buffers come back with their recent lines.
+#
+# Do not load the in-process script and the bridge for the same protocol at
+# the same time.
+#
+#   /python load daemon_bridge.py
+#   /set plugins.var.python.daemon_bridge.daemons "telegram,matrix"
+#   /daemon list | attach <name> | detach <name> | stop <name>
+#
+
+import weechat
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+
+SCRIPT_NAME    = "daemon_bridge"
+SCRIPT_AUTHOR  = "santanaoliva_u"
+SCRIPT_VERSION = "1.0.0"
+SCRIPT_LICENSE = "MIT"
+SCRIPT_DESC    = "Run the Telegram/Matrix scripts in background daemons"
+
+FRAME = struct.Struct("!I")
+DISPLAY_SIGNALS = ("buffer_switch", "window_switch", "window_opened", "window_closed")
+
+links       = {}  # name -> DaemonLink
+WEECHAT_DIR = None
+
+
+def pack(message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return FRAME.pack(len(body)) + body
+
+
+def unpack(data):
+    messages = []
+    while len(data) >= FRAME.size:
+        (size,) = FRAME.unpack_from(data)
+        if len(data) < FRAME.size + size:
+            break
+        messages.append(json.loads(data[FRAME.size:FRAME.size + size]))
+        del data[:FRAME.size + size]
+    return messages
+
+
+class DaemonLink:
+    """Socket to one daemon plus the WeeChat objects created on its behalf."""
+
+    RETRY_SECONDS = 5
+
+    def __init__(self, name):
+        self.name     = name
+        self.sock     = None
+        self.fd_hook  = None
+        self.data     = bytearray()
+        self.handles  = {}  # daemon or bridge handle -> WeeChat pointer
+        self.next     = 0
+        self.hooks    = {}  # daemon handle -> WeeChat hook pointer
+        self.bars     = {}  # bar item name -> content
+        self.buffers  = {}  # buffer name -> daemon handle, survives reattach
+        self.spawned  = False
+        self.manual   = False  # detached or stopped by /daemon: no automatic reattach
+
+    @property
+    def sock_path(self):
+        return os.path.join(WEECHAT_DIR, self.name, "daemon.sock")
+
+    def option(self, key):
+        return f"plugins.var.python.{self.name}.{key}"
+
+    # --- Connection ---------------------------------------------------------
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.sock_path)
+        except OSError:
+            sock.close()
+            if not self.spawned and weechat.config_string_to_boolean(weechat.config_get_plugin("autostart")):
+                self.spawn()
+            return False
+        sock.setblocking(False)
+        self.sock = sock
+        self.data.clear()
+        self.fd_hook = weechat.hook_fd(sock.fileno(), 1, 0, 0, "link_fd_cb", self.name)
+        self.send(["hello", self.config_snapshot()])
+        self.spawned = False  # Start it again if it dies later
+        weechat.prnt("", f"daemon_bridge: attached to {self.name}")
+        return True
+
+    def spawn(self):
+        script_dir = weechat.config_get_plugin("script_dir") or os.path.join(WEECHAT_DIR, "python")
+        daemon = os.path.join(script_dir, "protocol_daemon.py")
+        script = os.path.join(script_dir, f"{self.name}_http.py")
+        python = weechat.config_get_plugin("python") or sys.executable
+        os.makedirs(os.path.dirname(self.sock_path), exist_ok=True)
+        with open(os.path.join(WEECHAT_DIR, self.name, "daemon.out"), "ab") as out:
+            subprocess.Popen([python, daemon, script, "--socket", self.sock_path],
+                             stdin=subprocess.DEVNULL, stdout=out, stderr=out, start_new_session=True)
+        self.spawned = True
+        weechat.prnt("", f"daemon_bridge: started {self.name} daemon")
+
+    def close(self, reason=""):
+        if self.fd_hook:
+            weechat.unhook(self.fd_hook)
+            self.fd_hook = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        self.drop_remote()
+        if reason:
+            weechat.prnt("", f"daemon_bridge: {self.name} {reason}")
+
+    def drop_remote(self):
+        """Undo hooks of the old daemon session; buffers stay for the replay."""
+        for hook in self.hooks.values():
+            weechat.unhook(hook)
+        self.hooks.clear()
+        self.handles.clear()
+
+    def send(self, message):
+        if not self.sock:
+            return
+        try:
+            self.sock.setblocking(True)
+            self.sock.sendall(pack(message))
+            self.sock.setblocking(False)
+        except OSError:
+            self.close("detached")
+
+    def config_snapshot(self):
+        config = {}
+        prefix = self.option("")
+        infolist = weechat.infolist_get("option", "", f"{prefix}*")
+        while infolist and weechat.infolist_next(infolist):
+            config[weechat.infolist_string(infolist, "full_name")[len(prefix):]] = \
+                weechat.infolist_string(infolist, "value")
+        if infolist:
+            weechat.infolist_free(infolist)
+        return config
+
+    def push_displayed(self):
+        displayed = {}
+        for name, handle in self.buffers.items():
+            buf = self.handles.get(handle)
+            if buf:
+                displayed[handle] = weechat.buffer_get_integer(buf, "num_displayed")
+        if displayed:
+            self.send(["disp", displayed])
+
+    # --- Frames from the daemon ---------------------------------------------
+
+    def readable(self):
+        try:
+            while True:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    self.close("daemon exited")
+                    return
+                self.data += chunk
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close("detached")
+            return
+        for message in unpack(self.data):
+            try:
+                self.handle(message)
+            except Exception as e:
+                weechat.prnt("", f"daemon_bridge: {self.name}: {message[0]} failed: {e!r}")
+
+    def resolve(self, args):
+        """Replace handles by pointers; None if one of them is gone."""
+        out = []
+        for arg in args:
+            if isinstance(arg, str) and arg.startswith("0x@"):
+                arg = self.handles.get(arg)
+                if arg is None:
+                    return None
+            out.append(arg)
+        return out
+
+    def wrap(self, result):
+        """Hand out a handle for a pointer returned to the daemon."""
+        if isinstance(result, str) and result.startswith("0x"):
+            self.next += 1
+            handle = f"0x@b{self.next}"
+            self.handles[handle] = result
+            return handle
+        return result
+
+    def handle(self, message):
+        op = message[0]
+        if op == "c":
+            args = self.resolve(message[2])
+            if args is not None:
+                getattr(weechat, message[1])(*args)
+        elif op == "p":
+            args = self.resolve(message[3])
+            self.handles[message[1]] = getattr(weechat, message[2])(*args) if args is not None else ""
+        elif op == "s":
+            args = self.resolve(message[3])
+            result = getattr(weechat, message[2])(*args) if args is not None else ""
+            self.send(["r", message[1], self.wrap(result)])
+        elif op == "buf":
+            self.open_buffer(message[1], message[2])
+        elif op == "hook":
+            self.add_hook(message[1], message[2], message[3])
+        elif op == "unhook":
+            hook = self.hooks.pop(message[1], None)
+            if hook:
+                weechat.unhook(hook)
+        elif op == "bar":
+            if message[1] not in self.bars:
+                weechat.bar_item_new(message[1], "link_bar_cb", self.name)
+            self.bars[message[1]] = message[2]
+            weechat.bar_item_update(message[1])
+        elif op == "set":
+            if message[2] is None:
+                weechat.command("", f"/mute /unset {self.option(message[1])}")
+            else:
+                weechat.command("", f"/mute /set {self.option(message[1])} {json.dumps(message[2])}")
+        elif op == "reset":
+            self.drop_remote()
+        elif op == "free":
+            for handle in message[1]:
+                self.handles.pop(handle, None)
+
+    def open_buffer(self, handle, name):
+        buf = weechat.buffer_search("python", name)
+        if buf and name in self.buffers:
+            weechat.buffer_clear(buf)  # Lines are about to be replayed
+        else:
+            buf = weechat.buffer_new(name, "link_input_cb", f"{self.name}\t{name}",
+                                     "link_close_cb", f"{self.name}\t{name}")
+        self.buffers[name] = handle
+        self.handles[handle] = buf
+        self.send(["disp", {handle: weechat.buffer_get_integer(buf, "num_displayed")}])
+
+    def add_hook(self, handle, kind, args):
+        data = f"{self.name}\t{handle}"
+        if kind == "command":
+            hook = weechat.hook_command(*args, "link_command_cb", data)
+        elif kind == "signal":
+            hook = weechat.hook_signal(args[0], "link_signal_cb", data)
+        else:
+            hook = weechat.hook_config(args[0], "link_config_cb", data)
+        self.hooks[handle] = hook
+
+    def buffer_handle(self, buf):
+        """Daemon handle of a buffer pointer, or the pointer for buffers we don't own."""
+        for handle in self.buffers.values():
+            if self.handles.get(handle) == buf:
+                return handle
+        return buf
+
+
+# --- Callbacks ---------------------------------------------------------------
+
+def _link(data):
+    name, _, rest = data.partition("\t")
+    return links.get(name), rest
+
+def link_fd_cb(data, fd):
+    link = links.get(data)
+    if link and link.sock:
+        link.readable()
+    return weechat.WEECHAT_RC_OK
+
+def link_command_cb(data, buf, args):
+    link, handle = _link(data)
+    if link:
+        link.send(["cb", handle, [link.buffer_handle(buf), args]])
+    return weechat.WEECHAT_RC_OK
+
+def link_signal_cb(data, signal, signal_data):
+    link, handle = _link(data)
+    if link:
+        if signal in DISPLAY_SIGNALS:
+            link.push_displayed()
+        link.send(["cb", handle, [signal, link.buffer_handle(signal_data)]])
+    return weechat.WEECHAT_RC_OK
+
+def link_config_cb(data, option, value):
+    link, handle = _link(data)
+    if link:
+        if option.startswith(link.option("")):
+            link.send(["cfg", option[len(link.option("")):], value])
+        link.send(["cb", handle, [option, value]])
+    return weechat.WEECHAT_RC_OK
+
+def link_input_cb(data, buf, input_data):
+    link, name = _link(data)
+    if link and name in link.buffers:
+        link.send(["cb", link.buffers[name], [input_data]])
+    return weechat.WEECHAT_RC_OK
+
+def link_close_cb(data, buf):
+    link, name = _link(data)
+    if link:
+        handle = link.buffers.pop(name, None)
+        if handle:
+            link.handles.pop(handle, None)
+            link.send(["closed", handle])
+    return weechat.WEECHAT_RC_OK
+
+def link_bar_cb(data, item, window):
+    link = links.get(data)
+    return link.bars.get(item, "") if link else ""
+
+def mirror_config_cb(data, option, value):
+    """Keep every daemon's copy of its plugin options current."""
+    for link in links.values():
+        if option.startswith(link.option("")):
+            link.send(["cfg", option[len(link.option("")):], value])
+    return weechat.WEECHAT_RC_OK
+
+def displayed_cb(data, signal, signal_data):
+    for link in links.values():
+        link.push_displayed()
+    return weechat.WEECHAT_RC_OK
+
+def retry_cb(data, remaining):
+    for link in links.values():
+        if not link.sock and not link.manual:
+            link.connect()
+    return weechat.WEECHAT_RC_OK
+
+def daemon_cmd_cb(data, buf, args):
+    parts = args.split()
+    cmd = parts[0] if parts else "list"
+    link = links.get(parts[1]) if len(parts) > 1 else None
+    if cmd == "list":
+        for name, entry in links.items():
+            state = "attached" if entry.sock else "detached"
+            weechat.prnt("", f"daemon_bridge: {name} {state}, {len(entry.buffers)} buffers")
+    elif link and cmd == "attach":
+        link.manual = False
+        if not link.sock:
+            link.spawned = False
+            link.connect()
+    elif link and cmd == "detach":
+        link.manual = True
+        link.close("detached")
+    elif link and cmd == "stop":
+        link.manual = True
+        link.send(["stop"])
+        link.close("stopped")
+    else:
+        weechat.prnt("", "daemon_bridge: usage: /daemon list | attach <name> | detach <name> | stop <name>")
+    return weechat.WEECHAT_RC_OK
+
+def shutdown_cb():
+    for link in links.values():
+        link.close()  # The daemons keep running until /daemon stop
+    return weechat.WEECHAT_RC_OK
+
+
+if __name__ == "__main__":
+    if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "shutdown_cb", ""):
+        WEECHAT_DIR = weechat.info_get("weechat_dir", "") or os.path.expanduser("~/.weechat")
+        for key, (value, desc) in {
+            "daemons": ("telegram", "Comma separated scripts to run as daemons (telegram, matrix)"),
+            "script_dir": ("", "Directory with protocol_daemon.py and the *_http.py scripts (default: weechat_dir/python)"),
+            "python": ("", "Python interpreter for the daemons (default: the one running WeeChat's scripts)"),
+            "autostart": ("on", "Start a daemon that is not running (on/off)"),
+        }.items():
+            if not weechat.config_is_set_plugin(key):
+                weechat.config_set_plugin(key, value)
+                weechat.config_set_desc_plugin(key, desc)
+        for name in filter(None, (n.strip() for n in weechat.config_get_plugin("daemons").split(","))):
+            links[name] = DaemonLink(name)
+        weechat.hook_config("plugins.var.python.*", "mirror_config_cb", "")
+        for signal_name in DISPLAY_SIGNALS:
+            weechat.hook_signal(signal_name, "displayed_cb", "")
+        weechat.hook_command(
+            "daemon", "Manage protocol daemons",
+            "list | attach <name> | detach <name> | stop <name>",
+            "list: show daemons\nattach: connect (starting it if needed)\n"
+            "detach: disconnect, the daemon keeps running\nstop: shut the daemon down",
+            "list|attach|detach|stop", "daemon_cmd_cb", "")
+        for link in links.values():
+            link.connect()
+        weechat.hook_timer(DaemonLink.RETRY_SECONDS * 1000, 0, 0, "retry_cb", "")
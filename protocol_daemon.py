@@ -0,0 +1,610 @@
+# -*- coding: utf-8 -*-
+#
+# protocol_daemon.py — Run telegram_http.py or matrix_http.py outside WeeChat
+#
+# The script is executed unchanged in this process with a stand-in `weechat`
+# module. UI calls (prnt, buffers, nicklist, hdata, bar items, hooks) travel
+# to daemon_bridge.py inside WeeChat over a Unix socket; commands, input and
+# signals come back the same way. Networking, JSON parsing and Telethon crypto
+# then run on their own core, and the daemon stays connected while WeeChat
+# restarts: on reattach it recreates the buffers and replays recent lines.
+#
+# Usage (daemon_bridge.py normally starts it):
+#   python protocol_daemon.py ~/.weechat/python/telegram_http.py --socket ~/.weechat/telegram/daemon.sock
+#
+# Protocol: each frame is a 4-byte big-endian length followed by a compact
+# JSON array whose first item is the operation.
+#   daemon -> bridge
+#     ["c", func, args]            call weechat.func(*args), no reply
+#     ["p", handle, func, args]    same, remember the returned pointer as handle
+#     ["s", seq, func, args]       call and answer with ["r", seq, result]
+#     ["buf", handle, name]        create (or reuse) buffer `name` as handle
+#     ["hook", handle, kind, args] hook_command/signal/config on our behalf
+#     ["unhook", handle]
+#     ["bar", name, content]       bar item content, shown until the next update
+#     ["set", key, value]          set plugins.var.python.<script>.<key>
+#     ["reset"]                    forget handles; a replay of the UI state follows
+#     ["free", [handle, ...]]      the script dropped these pointers
+#   bridge -> daemon
+#     ["hello", config]            attach, with the script's plugin options
+#     ["r", seq, result]
+#     ["cb", handle, args]         a hook or buffer callback fired
+#     ["closed", handle]           the user closed a buffer
+#     ["cfg", key, value]          a plugin option changed (value None: removed)
+#     ["disp", {handle: n}]        num_displayed of the daemon's buffers
+#     ["stop"]                     run the script's shutdown callback and exit
+#
+
+import argparse
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict, deque
+from queue import Queue, Empty
+
+FRAME = struct.Struct("!I")
+
+# Calls whose result the scripts ignore: sent without waiting
+ASYNC_CALLS = {
+    "prnt", "prnt_date_tags", "prnt_y", "buffer_set", "buffer_clear", "buffer_close", "command",
+    "nicklist_remove_nick", "nicklist_remove_group", "nicklist_remove_all", "nicklist_nick_set",
+    "hdata_update",
+}
+# Calls returning a pointer that is only passed back to WeeChat: answered locally with a handle
+POINTER_CALLS = {"hdata_pointer", "hdata_move", "nicklist_add_nick", "nicklist_add_group"}
+# Answers for synchronous calls while no WeeChat is attached
+DETACHED = {"buffer_get_integer": 0, "config_integer": 0, "config_boolean": 0, "hdata_integer": 0}
+
+
+def pack(message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return FRAME.pack(len(body)) + body
+
+
+def unpack(data):
+    """Split complete frames off a bytearray; returns the decoded messages."""
+    messages = []
+    while len(data) >= FRAME.size:
+        (size,) = FRAME.unpack_from(data)
+        if len(data) < FRAME.size + size:
+            break
+        messages.append(json.loads(data[FRAME.size:FRAME.size + size]))
+        del data[:FRAME.size + size]
+    return messages
+
+
+class Handle(str):
+    """A pointer handle given to the script; the bridge forgets it once the script drops it.
+
+    __del__ may run on any thread and inside a locked section, so it only
+    appends to a deque that the next flush turns into a "free" frame.
+    """
+
+    __slots__ = ()
+    freed = deque()
+
+    def __del__(self):
+        Handle.freed.append(str(self))
+
+
+class BufferState:
+    """What is needed to rebuild one buffer after WeeChat reattaches."""
+
+    def __init__(self, name, callbacks, replay_lines):
+        self.name      = name
+        self.callbacks = callbacks  # (input_cb, input_data, close_cb, close_data)
+        self.props     = OrderedDict()  # buffer_set property -> value, localvars normalised
+        self.nicks     = OrderedDict()  # nick name -> nicklist_add_nick args
+        self.lines     = deque(maxlen=replay_lines)  # (date, tags, message)
+
+    def set(self, prop, value):
+        if prop.startswith("localvar_del_"):
+            self.props.pop(f"localvar_set_{prop[13:]}", None)
+        else:
+            self.props.pop(prop, None)
+            self.props[prop] = value
+
+
+class WeechatProxy(types.ModuleType):
+    """The `weechat` module as seen by a script running inside the daemon."""
+
+    WEECHAT_RC_OK = 0
+    WEECHAT_RC_OK_EAT = 1
+    WEECHAT_RC_ERROR = -1
+    WEECHAT_HOTLIST_LOW = "0"
+    WEECHAT_HOTLIST_MESSAGE = "1"
+    WEECHAT_HOTLIST_PRIVATE = "2"
+    WEECHAT_HOTLIST_HIGHLIGHT = "3"
+
+    def __init__(self, daemon):
+        super().__init__("weechat")
+        self._daemon = daemon
+        self._colors = {}
+        self._hdata  = {}  # hdata name -> handle; hdata pointers never change
+
+    # Registration and plugin options, answered from the mirror sent by the bridge
+
+    def register(self, name, author, version, license, description, shutdown_cb, charset):
+        self._daemon.script_name = name
+        self._daemon.shutdown_cb = shutdown_cb
+        return 1
+
+    def config_get_plugin(self, key):
+        return self._daemon.config.get(key, "")
+
+    def config_is_set_plugin(self, key):
+        return int(key in self._daemon.config)
+
+    def config_set_plugin(self, key, value):
+        self._daemon.config[key] = str(value)
+        self._daemon.send(["set", key, str(value)])
+        return 1
+
+    def config_unset_plugin(self, key):
+        self._daemon.config.pop(key, None)
+        self._daemon.send(["set", key, None])
+        return 1
+
+    def config_set_desc_plugin(self, key, description):
+        pass  # WeeChat only lets a script describe its own options
+
+    def config_string_to_boolean(self, value):
+        return int(value.lower() in ("on", "yes", "y", "true", "t", "1"))
+
+    # Hooks run in the daemon (timers, fds) or in WeeChat (the rest)
+
+    def hook_timer(self, interval, align_second, max_calls, callback, data):
+        return self._daemon.add_timer(interval, max_calls, callback, data)
+
+    def hook_fd(self, fd, read, write, exception, callback, data):
+        return self._daemon.add_fd(fd, callback, data)
+
+    def hook_command(self, *args):
+        return self._daemon.remote_hook("command", args[:-2], args[-2], args[-1])
+
+    def hook_signal(self, signal_name, callback, data):
+        return self._daemon.remote_hook("signal", (signal_name,), callback, data)
+
+    def hook_config(self, option, callback, data):
+        return self._daemon.remote_hook("config", (option,), callback, data)
+
+    def unhook(self, hook):
+        self._daemon.unhook(hook)
+
+    def bar_item_new(self, name, callback, data):
+        return self._daemon.add_bar(name, callback, data)
+
+    def bar_item_update(self, name):
+        self._daemon.update_bar(name)
+
+    # Buffers, lines and nicklist: sent on, and kept for the replay
+
+    def buffer_new(self, name, input_cb, input_data, close_cb, close_data):
+        return self._daemon.new_buffer(name, (input_cb, input_data, close_cb, close_data))
+
+    def buffer_set(self, buf, prop, value):
+        state = self._daemon.buffers.get(buf)
+        if state:
+            state.set(prop, value)
+        self._daemon.send(["c", "buffer_set", [buf, prop, value]])
+
+    def buffer_search(self, plugin, name):
+        # The script's own buffers are known here, attached or not
+        for handle, state in self._daemon.buffers.items():
+            if state.name == name:
+                return handle
+        return self._daemon.call("buffer_search", plugin, name)
+
+    def buffer_get_integer(self, buf, prop):
+        if prop == "num_displayed" and buf in self._daemon.buffers:
+            return self._daemon.displayed.get(buf, 0)
+        return self._daemon.call("buffer_get_integer", buf, prop)
+
+    def prnt(self, buf, message):
+        self.prnt_date_tags(buf, 0, "", message)
+
+    def prnt_date_tags(self, buf, date, tags, message):
+        state = self._daemon.buffers.get(buf)
+        if state:
+            state.lines.append((date or int(time.time()), tags, message))
+        self._daemon.send(["c", "prnt_date_tags", [buf, date, tags, message]])
+
+    def nicklist_add_nick(self, buf, group, name, color, prefix, prefix_color, visible):
+        state = self._daemon.buffers.get(buf)
+        if state:
+            state.nicks[name] = [buf, "", name, color, prefix, prefix_color, visible]
+        return self._daemon.pointer_call("nicklist_add_nick", buf, group, name, color, prefix, prefix_color, visible)
+
+    def nicklist_search_nick(self, buf, group, name):
+        nick = self._daemon.call("nicklist_search_nick", buf, group, name)
+        if nick:
+            self._daemon.nick_names[nick] = (buf, name)
+        return nick
+
+    def nicklist_remove_nick(self, buf, nick):
+        state = self._daemon.buffers.get(buf)
+        owner = self._daemon.nick_names.pop(nick, None)
+        if state and owner:
+            state.nicks.pop(owner[1], None)
+        self._daemon.send(["c", "nicklist_remove_nick", [buf, nick]])
+
+    def nicklist_remove_all(self, buf):
+        state = self._daemon.buffers.get(buf)
+        if state:
+            state.nicks.clear()
+        self._daemon.send(["c", "nicklist_remove_all", [buf]])
+
+    def hdata_get(self, name):
+        if name not in self._hdata:
+            self._hdata[name] = self._daemon.pointer_call("hdata_get", name)
+        return self._hdata[name]
+
+    def color(self, name):
+        if name not in self._colors:
+            value = self._daemon.call("color", name)
+            if not self._daemon.attached:
+                return value
+            self._colors[name] = value
+        return self._colors[name]
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if name in ASYNC_CALLS:
+            return lambda *args: self._daemon.send(["c", name, list(args)])
+        if name in POINTER_CALLS:
+            return lambda *args: self._daemon.pointer_call(name, *args)
+        return lambda *args: self._daemon.call(name, *args)
+
+
+class Daemon:
+    SYNC_TIMEOUT = 5  # seconds to wait for WeeChat to answer a synchronous call
+
+    def __init__(self, script, sock_path, replay_lines):
+        self.script       = script
+        self.sock_path    = sock_path
+        self.replay_lines = replay_lines
+        self.script_name  = None
+        self.shutdown_cb  = None
+        self.namespace    = None  # globals of the running script
+        self.config       = {}  # plugin options mirrored from WeeChat
+        self.displayed    = {}  # buffer handle -> num_displayed reported by the bridge
+        self.conn         = None  # socket of the attached bridge
+        self.out          = bytearray()
+        self.out_lock     = threading.Lock()
+        self.pending      = {}  # seq -> [threading.Event, result]
+        self.seq          = 0
+        self.inbound      = Queue()  # (conn, message) from reader threads
+        self.timers       = {}  # handle -> [due, interval, remaining, callback, data]
+        self.fds          = {}  # fd -> (handle, callback, data)
+        self.hooks        = OrderedDict()  # handle -> (kind, args, callback, data) registered in WeeChat
+        self.bars         = OrderedDict()  # name -> [callback, data, content]
+        self.buffers      = OrderedDict()  # handle -> BufferState
+        self.nick_names   = {}  # nick pointer -> (buffer, name), for nicklist_remove_nick
+        self.next_handle  = 0
+        self.nonce        = f"{os.getpid():x}{int(time.time()) & 0xffff:x}"
+        self.main_thread  = threading.get_ident()
+        self.running      = True
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+
+    @property
+    def attached(self):
+        return self.conn is not None
+
+    def handle(self):
+        self.next_handle += 1
+        return f"0x@{self.nonce}.{self.next_handle}"
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    # --- Sending ------------------------------------------------------------
+
+    def send(self, message):
+        """Queue a frame; the main loop flushes once per iteration, other threads at once."""
+        if self.conn is None:
+            return
+        with self.out_lock:
+            self.out += pack(message)
+            if threading.get_ident() != self.main_thread or len(self.out) > 65536:
+                self._flush_locked()
+
+    def flush(self):
+        with self.out_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if Handle.freed:
+            handles = []
+            while Handle.freed:
+                handles.append(Handle.freed.popleft())
+            if self.conn is not None:
+                self.out += pack(["free", handles])
+        if not self.out or self.conn is None:
+            self.out.clear()
+            return
+        try:
+            self.conn.sendall(self.out)
+        except OSError:
+            self.inbound.put((self.conn, ["detach"]))
+            self.wake()
+        self.out.clear()
+
+    def call(self, func, *args):
+        """Synchronous WeeChat call; a default answer while detached."""
+        if self.conn is None:
+            return DETACHED.get(func, "")
+        entry = [threading.Event(), DETACHED.get(func, "")]
+        with self.out_lock:
+            self.seq += 1
+            seq = self.seq
+            self.pending[seq] = entry
+            self.out += pack(["s", seq, func, list(args)])
+            self._flush_locked()
+        entry[0].wait(self.SYNC_TIMEOUT)
+        self.pending.pop(seq, None)
+        if isinstance(entry[1], str) and entry[1].startswith("0x@"):
+            return Handle(entry[1])  # A pointer the bridge wrapped
+        return entry[1]
+
+    def pointer_call(self, func, *args):
+        handle = Handle(self.handle())
+        self.send(["p", handle, func, list(args)])
+        return handle
+
+    # --- Hooks and bar items ------------------------------------------------
+
+    def add_timer(self, interval, max_calls, callback, data):
+        handle = self.handle()
+        interval = max(1, interval) / 1000
+        self.timers[handle] = [time.monotonic() + interval, interval, max_calls or -1, callback, data]
+        return handle
+
+    def add_fd(self, fd, callback, data):
+        handle = self.handle()
+        self.fds[fd] = (handle, callback, data)
+        return handle
+
+    def remote_hook(self, kind, args, callback, data):
+        handle = self.handle()
+        self.hooks[handle] = (kind, list(args), callback, data)
+        self.send(["hook", handle, kind, list(args)])
+        return handle
+
+    def unhook(self, hook):
+        if self.timers.pop(hook, None):
+            return
+        for fd, entry in list(self.fds.items()):
+            if entry[0] == hook:
+                del self.fds[fd]
+                return
+        if self.hooks.pop(hook, None):
+            self.send(["unhook", hook])
+
+    def add_bar(self, name, callback, data):
+        self.bars[name] = [callback, data, ""]
+        self.update_bar(name)
+        return name
+
+    def update_bar(self, name):
+        bar = self.bars.get(name)
+        if bar:
+            bar[2] = self.run(bar[0], bar[1], name, "") or ""
+            self.send(["bar", name, bar[2]])
+
+    def new_buffer(self, name, callbacks):
+        handle = self.handle()
+        self.buffers[handle] = BufferState(name, callbacks, self.replay_lines)
+        self.send(["buf", handle, name])
+        return handle
+
+    def run(self, callback, *args):
+        """Call a function of the script by name, as WeeChat would."""
+        func = self.namespace.get(callback) if self.namespace else None
+        if func is None:
+            return None
+        try:
+            return func(*args)
+        except Exception as e:
+            print(f"protocol_daemon: error in {callback}: {e!r}", file=sys.stderr)
+            return None
+
+    # --- Bridge connection --------------------------------------------------
+
+    def _reader(self, conn):
+        data = bytearray()
+        while True:
+            try:
+                chunk = conn.recv(65536)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                break
+            data += chunk
+            for message in unpack(data):
+                if message[0] == "r":
+                    entry = self.pending.get(message[1])
+                    if entry:
+                        entry[1] = message[2]
+                        entry[0].set()
+                else:
+                    self.inbound.put((conn, message))
+                    self.wake()
+        self.inbound.put((conn, ["detach"]))
+        self.wake()
+
+    def accept(self, server):
+        conn, _ = server.accept()
+        if self.conn is not None:
+            self.detach(self.conn)
+        threading.Thread(target=self._reader, args=(conn,), name="bridge-reader", daemon=True).start()
+        # Attached only once the hello arrives, so nothing is sent before the replay
+
+    def detach(self, conn):
+        if conn is not self.conn:
+            conn.close()
+            return
+        with self.out_lock:
+            self.conn = None
+            self.out.clear()
+        for entry in list(self.pending.values()):
+            entry[0].set()  # Waiters fall back to the detached answer
+        conn.close()
+        self.displayed.clear()
+        print("protocol_daemon: WeeChat detached", file=sys.stderr)
+
+    def hello(self, conn, config):
+        with self.out_lock:
+            self.conn = conn
+        self.config.update(config)
+        if self.namespace is None:
+            self.start_script()
+        else:
+            self.replay()
+
+    def replay(self):
+        """Rebuild hooks, bar items, buffers and recent lines in a fresh WeeChat."""
+        self.send(["reset"])
+        self.proxy._colors.clear()
+        for name, handle in self.proxy._hdata.items():
+            self.send(["p", handle, "hdata_get", [name]])
+        for handle, (kind, args, _, _) in self.hooks.items():
+            self.send(["hook", handle, kind, args])
+        for name in self.bars:
+            self.update_bar(name)
+        for handle, state in self.buffers.items():
+            self.send(["buf", handle, state.name])
+            for prop, value in state.props.items():
+                self.send(["c", "buffer_set", [handle, prop, value]])
+            for args in state.nicks.values():
+                self.send(["c", "nicklist_add_nick", args])
+            for date, tags, message in state.lines:
+                self.send(["c", "prnt_date_tags", [handle, date, tags, message]])
+
+    def start_script(self):
+        self.proxy = WeechatProxy(self)
+        sys.modules["weechat"] = self.proxy
+        sys.path.insert(0, os.path.dirname(os.path.abspath(self.script)))
+        self.namespace = {"__name__": "__main__", "__file__": self.script}
+        with open(self.script) as f:
+            code = compile(f.read(), self.script, "exec")
+        exec(code, self.namespace)
+
+    def dispatch(self, conn, message):
+        op = message[0]
+        if op == "detach":
+            self.detach(conn)
+        elif conn is not self.conn and op != "hello":
+            return  # Late frame from a replaced bridge
+        elif op == "hello":
+            self.hello(conn, message[1])
+        elif op == "cb":
+            self.callback(message[1], message[2])
+        elif op == "closed":
+            state = self.buffers.pop(message[1], None)
+            self.displayed.pop(message[1], None)
+            if state:
+                self.run(state.callbacks[2], state.callbacks[3], message[1])
+        elif op == "cfg":
+            if message[2] is None:
+                self.config.pop(message[1], None)
+            else:
+                self.config[message[1]] = message[2]
+        elif op == "disp":
+            self.displayed.update(message[1])
+        elif op == "stop":
+            self.running = False
+
+    def callback(self, handle, args):
+        if handle in self.hooks:
+            _, _, callback, data = self.hooks[handle]
+            self.run(callback, data, *args)
+        elif handle in self.buffers:
+            input_cb, input_data = self.buffers[handle].callbacks[:2]
+            self.run(input_cb, input_data, handle, *args)
+
+    # --- Main loop ----------------------------------------------------------
+
+    def serve(self):
+        if os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+        os.makedirs(os.path.dirname(self.sock_path), exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.sock_path)
+        os.chmod(self.sock_path, 0o600)
+        server.listen(1)
+        signal.signal(signal.SIGTERM, lambda *_: self.stop_soon())
+        print(f"protocol_daemon: {self.script} on {self.sock_path}", file=sys.stderr)
+        try:
+            while self.running:
+                self.iterate(server)
+        finally:
+            if self.shutdown_cb:
+                self.run(self.shutdown_cb)
+            self.flush()
+            server.close()
+            os.unlink(self.sock_path)
+
+    def stop_soon(self):
+        self.running = False
+        self.wake()
+
+    def iterate(self, server):
+        now = time.monotonic()
+        timeout = min((t[0] for t in self.timers.values()), default=now + 1) - now
+        ready, _, _ = select.select([server, self.wake_r] + list(self.fds), [], [], max(0, timeout))
+        if server in ready:
+            self.accept(server)
+        if self.wake_r in ready:
+            try:
+                while os.read(self.wake_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        while True:
+            try:
+                conn, message = self.inbound.get_nowait()
+            except Empty:
+                break
+            self.dispatch(conn, message)
+        for fd in ready:
+            entry = self.fds.get(fd)
+            if entry:
+                self.run(entry[1], entry[2], fd)
+        now = time.monotonic()
+        for handle, timer in list(self.timers.items()):
+            if timer[0] <= now and handle in self.timers:
+                timer[0] = now + timer[1]
+                if timer[2] > 0:
+                    timer[2] -= 1
+                    if timer[2] == 0:
+                        del self.timers[handle]
+                self.run(timer[3], timer[4], timer[2])
+        self.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a WeeChat script out of process behind a Unix socket.")
+    parser.add_argument("script", help="path of telegram_http.py or matrix_http.py")
+    parser.add_argument("--socket", help="socket path (default ~/.weechat/<name>/daemon.sock)")
+    parser.add_argument("--replay-lines", type=int, default=200, help="lines per buffer replayed on reattach")
+    args = parser.parse_args()
+    name = os.path.basename(args.script).split("_")[0].split(".")[0]
+    sock_path = args.socket or os.path.expanduser(f"~/.weechat/{name}/daemon.sock")
+    Daemon(os.path.abspath(args.script), sock_path, args.replay_lines).serve()
+
+
+if __name__ == "__main__":
+    main()